@@ -18,14 +18,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import logging
+import re
 import pyparsing as pp
 
 logger = logging.getLogger(__name__)
 
+# the quoted parts of a (concatenated) string literal, comments in between are matched so quotes in them are skipped
+STRING_PARTS_RE = re.compile(r'"([^"\n\r]*)"|--[^\n]*')
+
 class BSDLFile:
     """BSDL parser"""
 
     class Declaration:
+        __slots__ = ("name", "type_", "value", "direction", "range_start", "range_end", "owner")
+
         def __init__(self, name, type_, value=None, direction=None, range_start=None, range_end=None, owner=None):
             self.name = name
             self.type_ = type_
@@ -35,6 +41,8 @@ class BSDLFile:
             self.range_end = range_end
             self.owner = owner
 
+    _grammar = None
+
     def __init__(self, name):
         self.name = name
         self.generics = {}
@@ -42,23 +50,39 @@ class BSDLFile:
         self.constants = {}
         self.attributes = {}
 
+    @staticmethod
+    def _join_string_literal(tokens):
+        parts = []
+        for m in STRING_PARTS_RE.finditer(tokens[0]):
+            part = m.group(1)
+            if part is None: continue # comment
+            if "\\" in part:
+                # rare, unescape like QuotedString does
+                part = pp.QuotedString("\"").parse_string(f'"{part}"')[0]
+            parts.append(part)
+        return "".join(parts)
+
     @classmethod
-    def parse(cls, f):
-        comments = "--" + pp.SkipTo(pp.LineEnd())
+    def _build_grammar(cls):
+        comments = pp.Regex(r"--[^\n]*")
         identifier = pp.Word(init_chars=pp.srange("[a-zA-Z]"), body_chars=pp.srange("[a-zA-Z0-9_]"))
-        string_literal = pp.Combine(pp.QuotedString("\"") +
-                                    pp.ZeroOrMore(pp.Suppress(pp.Literal("&")) + pp.QuotedString("\"")), adjacent=False)
-        numeric_literal = pp.Or((pp.pyparsing_common.sci_real, pp.pyparsing_common.integer))
+        # matched with a single regex; the long "..." & "..." strings (like the boundary register) make up most of a
+        # BSDL file, and a QuotedString per part unescapes them character by character
+        string_literal = pp.Regex(r'"[^"\n\r]*"(?:(?:\s|--[^\n]*)*&(?:\s|--[^\n]*)*"[^"\n\r]*")*')
+        string_literal.set_parse_action(cls._join_string_literal)
+        # all alternatives below start differently, so the first match is the only one; MatchFirst stops there, where
+        # Or would try every alternative to find the longest match
+        numeric_literal = pp.MatchFirst((pp.pyparsing_common.sci_real, pp.pyparsing_common.integer))
         primary = pp.Forward()
         enumeration_literal = (pp.Suppress(pp.Literal("(")) + primary +
                                pp.ZeroOrMore(pp.Suppress(pp.Literal(",")) + primary) + pp.Suppress(pp.Literal(")")))
-        literal = pp.Or((numeric_literal, enumeration_literal, string_literal))
-        primary <<= pp.Or((identifier, literal))
+        literal = pp.MatchFirst((string_literal, numeric_literal, enumeration_literal))
+        primary <<= pp.MatchFirst((identifier, literal))
         expression = primary
-        mode = pp.Or((pp.CaselessKeyword("in"), pp.CaselessKeyword("out"), pp.CaselessKeyword("inout"),
-                     pp.CaselessKeyword("buffer"), pp.CaselessKeyword("linkage")))
+        mode = pp.MatchFirst((pp.CaselessKeyword("in"), pp.CaselessKeyword("out"), pp.CaselessKeyword("inout"),
+                             pp.CaselessKeyword("buffer"), pp.CaselessKeyword("linkage")))
         range = (pp.Suppress(pp.Literal("(")) + pp.pyparsing_common.integer +
-                 pp.Or((pp.CaselessKeyword("to"), pp.CaselessKeyword("downto"))) +
+                 pp.MatchFirst((pp.CaselessKeyword("to"), pp.CaselessKeyword("downto"))) +
                  pp.pyparsing_common.integer + pp.Suppress(pp.Literal(")")))
         subtype_indication = identifier + pp.Optional(range)
         declaration = pp.Group(identifier + pp.Suppress(pp.Literal(":")) +
@@ -72,7 +96,7 @@ class BSDLFile:
         use_clause = pp.Group(pp.CaselessKeyword("use") + identifier + pp.Literal(".") + identifier +
                               pp.ZeroOrMore(pp.Literal(",") + identifier) +
                               pp.Suppress(pp.Literal(";")))
-        class_ = pp.Or((pp.CaselessKeyword("entity"), pp.CaselessKeyword("signal")))
+        class_ = pp.MatchFirst((pp.CaselessKeyword("entity"), pp.CaselessKeyword("signal")))
         attribute_specification = pp.Group(pp.CaselessKeyword("attribute") + identifier +
                                            pp.Suppress(pp.CaselessKeyword("of")) + identifier +
                                            pp.Suppress(pp.Literal(":")) + class_ +
@@ -80,7 +104,7 @@ class BSDLFile:
                                            pp.Suppress(pp.Literal(";")))
         constant_declaration = pp.Group(pp.CaselessKeyword("constant") + declaration + pp.Suppress(pp.Literal(";")))
         entity_header = pp.Optional(generic_clause) + pp.Optional(port_clause)
-        entity_declarative_item = pp.Or((use_clause, attribute_specification, constant_declaration))
+        entity_declarative_item = pp.MatchFirst((attribute_specification, use_clause, constant_declaration))
         entity_declaration = (pp.Suppress(pp.CaselessKeyword("entity")) + identifier + pp.Suppress(pp.CaselessKeyword("is")) +
                               entity_header + pp.ZeroOrMore(entity_declarative_item) +
                               pp.Suppress(pp.CaselessKeyword("end") + pp.Optional(pp.CaselessKeyword("entity")) +
@@ -89,8 +113,15 @@ class BSDLFile:
         bsdl_file = entity_declaration + pp.StringEnd()
 
         bsdl_file.ignore(comments)
+        bsdl_file.streamline()
+        return bsdl_file
 
-        parsed = bsdl_file.parse_string(f.read())
+    @classmethod
+    def parse(cls, f):
+        # the grammar is built once and reused for every file
+        if cls._grammar is None:
+            cls._grammar = cls._build_grammar()
+        parsed = cls._grammar.parse_string(f.read())
         # parsed.pprint()
         r = cls(parsed[0])
         for item in parsed[1:]:
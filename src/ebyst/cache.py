@@ -0,0 +1,104 @@
+# Copyright (c) 2024 Sijmen Woutersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import io
+import logging
+import os
+import pickle
+
+logger = logging.getLogger(__name__)
+
+_source_hash = None
+
+def source_hash():
+    """Hash of the ebyst sources, changes whenever a (pickled) class may have changed"""
+    global _source_hash
+    if _source_hash is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith(".py"):
+                    path = os.path.join(dirpath, fn)
+                    h.update(os.path.relpath(path, root).encode())
+                    with open(path, "rb") as f:
+                        h.update(f.read())
+        _source_hash = h.hexdigest()[:16]
+    return _source_hash
+
+class PickleCache:
+    """Mixin caching parsed objects as pickles, keyed by the hash of the parsed text and of the ebyst sources.
+       Subclasses set CACHE_SUFFIX"""
+    # parsed file cache, can be moved with EBYST_CACHE_DIR (EBYST_STAPL_CACHE_DIR is still accepted)
+    CACHE_DIR = (os.environ.get("EBYST_CACHE_DIR") or os.environ.get("EBYST_STAPL_CACHE_DIR") or
+                 os.path.join(os.path.expanduser("~"), ".cache", "ebyst"))
+    CACHE_SUFFIX = None
+
+    def dump(self, path):
+        """Pickle self to path; the file is written atomically, so concurrent loads never see a partial file"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Load an object pickled with dump"""
+        with open(path, "rb") as f:
+            obj = pickle.load(f)
+        if not isinstance(obj, cls):
+            raise pickle.UnpicklingError(f"{path} does not contain a {cls.__name__}")
+        return obj
+
+    @classmethod
+    def load_cached(cls, f, parse=None):
+        """Same as parse(f) (cls.parse by default), but the result is pickled in CACHE_DIR, so subsequent loads of the
+           same file don't need to parse it again"""
+        if parse is None: parse = cls.parse
+        text = f.read()
+        h = hashlib.sha256(text.encode()).hexdigest()
+        # the sources are part of the key, so a pickle with an old class layout is never loaded, whether ebyst was
+        # upgraded or edited in place
+        cache_fn = os.path.join(cls.CACHE_DIR, f"{h}.{cls.CACHE_SUFFIX}.{source_hash()}.pkl")
+        try:
+            obj = cls.load(cache_fn)
+            logger.debug("%s loaded from %s", cls.__name__, cache_fn)
+            return obj
+        except FileNotFoundError:
+            logger.debug("%s not cached yet", cls.__name__)
+        except Exception as e:
+            # corrupt or stale (e.g. refers to a renamed class or module) cache file, parse again
+            logger.debug("Ignoring cache %s: %r", cache_fn, e)
+
+        obj = parse(io.StringIO(text))
+        try:
+            os.makedirs(cls.CACHE_DIR, exist_ok=True)
+            obj.dump(cache_fn)
+        except OSError as e:
+            logger.warning("Could not write cache %s: %s", cache_fn, e)
+        return obj
@@ -19,11 +19,12 @@
 # SOFTWARE.
 import logging
 import re
-from pprint import pprint
 
 from bitarray import bitarray
+from bitarray.util import ones
 
 from .bsdl import BSDLFile
+from .cache import PickleCache
 
 SPACE = "[ \r\n\t]*"
 
@@ -38,9 +39,16 @@ class StdLogicPattern:
         for c in pattern.upper():
             if not c in "01X": raise Exception(f"{c} not supported in bit pattern")
         self.pattern = pattern.upper()
+        # bit i of the masks corresponds to pattern[i], so bitarrays can be compared as a single integer
+        self.care_mask = sum(1 << i for i, c in enumerate(self.pattern) if c != "X")
+        self.value_mask = sum(1 << i for i, c in enumerate(self.pattern) if c == "1")
 
     def __eq__(self, other):
         if len(self.pattern) != len(other): return False
+        if isinstance(other, bitarray):
+            if other.endian != 'little': other = bitarray(other, endian='little')
+            # not ba2int, it rejects empty bitarrays; pad bits of tobytes() are always 0
+            return (int.from_bytes(other.tobytes(), "little") & self.care_mask) == self.value_mask
         for c1, c2 in zip(self.pattern, other):
             if c1 != "X" and int(c1) != int(c2): return False
         return True
@@ -190,13 +198,15 @@ class PinGroup(list):
             r.append(pin.get_value())
         return r
 
-class Device:
+class Device(PickleCache):
+    CACHE_SUFFIX = "device"
+
     def __init__(self, irlen, max_freq=None, idcode=None, opcodes=None, cells=[]):
         self.ctl = None
         self.irlen = irlen
         self.max_freq = max_freq
         self.idcode = idcode
-        if opcodes is None: opcodes = {'BYPASS': bitarray('1' * irlen, endian='little')}
+        if opcodes is None: opcodes = {'BYPASS': ones(irlen, 'little')}
         if not 'BYPASS' in opcodes: raise ValueError("BYPASS command is required")
         self.opcodes = opcodes
         self.cells = cells
@@ -222,19 +232,23 @@ class Device:
 
     def update_br(self, br):
         if len(br) != len(self.cells): raise ValueError("Invalid br length")
-        for i, v in enumerate(br):
-            self.cells[i].in_value = v
+        for cell, v in zip(self.cells, br.tolist()):
+            cell.in_value = v
 
     def generate_br(self):
-        r = bitarray(endian='little')
-        for cell in self.cells:
-            r.append(cell.out_value)
-        return r
+        # built from a list in one go, instead of appending cell by cell
+        return bitarray([cell.out_value for cell in self.cells], endian='little')
 
     @staticmethod
-    def from_bsdl(fn):
+    def from_bsdl(fn, cached=False):
+        """Create device from a BSDL file; with cached=True the device is cached (see PickleCache.load_cached), so
+           later loads skip both parsing the file and building the cells"""
         with open(fn, "rt") as f:
-            bsdi_file = BSDLFile.parse(f)
+            return Device.load_cached(f, Device._from_bsdl_file) if cached else Device._from_bsdl_file(f)
+
+    @staticmethod
+    def _from_bsdl_file(f):
+        bsdi_file = BSDLFile.parse(f)
 
         max_freq = float(bsdi_file.attributes["TAP_SCAN_CLOCK"].value)
 
@@ -243,30 +257,33 @@ class Device:
 
         opcodes = {}
         opcode_str = bsdi_file.attributes['INSTRUCTION_OPCODE'].value
+        # match at increasing positions, instead of slicing off (and copying) the rest of the string after every match
+        pos = 0
         while True:
-            m = RE_OPCODE.match(opcode_str)
+            m = RE_OPCODE.match(opcode_str, pos)
             if m:
                 opcode = m['opcode'].split(",")
                 ba = bitarray(opcode[0].strip(), endian='little')
                 ba.reverse()
                 opcodes[m['instruction'].upper()] = ba
-                opcode_str = opcode_str[m.end():]
+                pos = m.end()
             else:
                 break
-        if len(opcode_str) != 0: raise Exception("Invalid INSTRUCTION_OPCODE format")
+        if pos != len(opcode_str): raise Exception("Invalid INSTRUCTION_OPCODE format")
 
         brlen = int(bsdi_file.attributes['BOUNDARY_LENGTH'].value)
 
         cells = [None] * brlen
         cell_str = bsdi_file.attributes['BOUNDARY_REGISTER'].value.strip()
+        pos = 0
         while True:
-            m = RE_CELL.match(cell_str)
+            m = RE_CELL.match(cell_str, pos)
             if m:
                 cell = Cell.parse(int(m['index']), m['config'])
                 cells[cell.num] = cell
-                cell_str = cell_str[m.end():]
+                pos = m.end()
             else:
                 break
-        if len(cell_str) != 0: raise Exception("Invalid BOUNDARY_REGISTER format")
+        if pos != len(cell_str): raise Exception("Invalid BOUNDARY_REGISTER format")
 
         return Device(irlen=irlen, max_freq=max_freq, idcode=idcode, opcodes=opcodes, cells=cells)
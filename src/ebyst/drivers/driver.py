@@ -17,6 +17,8 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import contextlib
+
 from bitarray import bitarray
 
 class Driver:
@@ -26,6 +28,12 @@ class Driver:
     def set_freq(self, freq):
         pass
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the operations in the with block; drivers with a high per-transaction cost can send them to the
+           hardware at once (results which are read back inside the block are still returned immediately)"""
+        yield
+
     def transfer(self, tms: int, tdi: int) -> int:
         raise NotImplementedError()
 
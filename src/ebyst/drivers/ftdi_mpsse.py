@@ -17,6 +17,7 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import contextlib
 import time
 from bitarray import bitarray
 from bitarray.util import ba2int, int2ba
@@ -34,6 +35,27 @@ class MPSSE(Driver):
         self.ftdi = Ftdi()
         self.ftdi.open_mpsse_from_url(self.url, direction=1|2|8, initial=0, frequency=1e6, latency=1)
         self.ftdi.reset()
+        self._pending = None # commands queued inside a batch() block
+
+    @contextlib.contextmanager
+    def batch(self):
+        if not self._pending is None:
+            # nested batch, flushed by the outer one
+            yield
+            return
+        self._pending = bytearray()
+        try:
+            yield
+        finally:
+            pending = self._pending
+            self._pending = None
+            if len(pending) > 0: self.ftdi.write_data(pending)
+
+    def _write(self, data):
+        if self._pending is None:
+            self.ftdi.write_data(data)
+        else:
+            self._pending += data
 
     def set_freq(self, freq):
         freq_orig = freq
@@ -41,6 +63,10 @@ class MPSSE(Driver):
             freq *= 0.9
 
     def _read_bytes(self, count):
+        # queued commands have to be sent before their results can be read
+        if self._pending:
+            self.ftdi.write_data(self._pending)
+            self._pending = bytearray()
         r = bytearray()
         while len(r) < count:
             r += self.ftdi.read_data(count - len(r))
@@ -62,7 +88,7 @@ class MPSSE(Driver):
         return urls
 
     def transfer(self, tms, tdi):
-        self.ftdi.write_data(bytearray((Ftdi.RW_BITS_TMS_PVE_NVE, 0, (0x80 if tdi else 0) | (1 if tms else 0))))
+        self._write(bytearray((Ftdi.RW_BITS_TMS_PVE_NVE, 0, (0x80 if tdi else 0) | (1 if tms else 0))))
         rd = self._read_bytes(1)
         return (rd[0] & 0x80) >> 7
 
@@ -70,55 +96,70 @@ class MPSSE(Driver):
         tdi = 0x80 if tdi else 0
         w = bytearray()
         for i in range(0, len(tms_str), 7):
-            part = tms_str[i:i+7].copy()
+            part = tms_str[i:i+7]
             w += bytearray((Ftdi.WRITE_BITS_TMS_NVE, len(part)-1, tdi | ba2int(part)))
-        self.ftdi.write_data(w)
+        self._write(w)
+
+    @staticmethod
+    def _shift_commands(tdi_str: bitarray, bytes_cmd, bits_cmd):
+        """MPSSE commands shifting tdi_str; whole bytes are clocked with bytes_cmd (up to 64k bytes per command), the
+           remaining bits with bits_cmd"""
+        w = bytearray()
+        nbytes = len(tdi_str) // 8
+        for i in range(0, nbytes, 0x10000):
+            n = min(nbytes - i, 0x10000)
+            w += bytearray((bytes_cmd, (n - 1) & 0xff, (n - 1) >> 8))
+            w += tdi_str[i*8:(i+n)*8].tobytes()
+        if len(tdi_str) > nbytes * 8:
+            part = tdi_str[nbytes*8:]
+            w += bytearray((bits_cmd, len(part)-1, ba2int(part)))
+        return w
 
     def transmit_tdi_str(self, tdi_str: bitarray, first_tms=0, last_tms=None):
         if last_tms is None: last_tms = first_tms
         if len(tdi_str) < 1: raise ValueError("n must be > 0")
         if len(tdi_str) == 1 and first_tms != last_tms: raise ValueError("last_tms must be first_tms when n == 1")
 
-        tdi_str = tdi_str.copy()
-        last_tdi = tdi_str.pop()
+        # slice instead of pop(), the caller's string may be a (cached) frozenbitarray
+        last_tdi = tdi_str[-1]
+        tdi_str = tdi_str[:-1]
         w = bytearray()
         if len(tdi_str) > 0:
             w += bytearray((Ftdi.WRITE_BITS_TMS_NVE, 0, (tdi_str[0] << 7) | (1 if first_tms else 0)))
-            for i in range(1, len(tdi_str), 8):
-                part = tdi_str[i:i+8].copy()
-                w += bytearray((Ftdi.WRITE_BITS_NVE_LSB, len(part)-1, ba2int(part)))
+            w += self._shift_commands(tdi_str[1:], Ftdi.WRITE_BYTES_NVE_LSB, Ftdi.WRITE_BITS_NVE_LSB)
         w += bytearray((Ftdi.WRITE_BITS_TMS_NVE, 0, (last_tdi << 7) | (1 if last_tms else 0)))
-        self.ftdi.write_data(w)
+        self._write(w)
 
     def transfer_tdi_tdo_str(self, tdi_str: bitarray, first_tms=0, last_tms=0) -> bitarray:
         if last_tms is None: last_tms = first_tms
         if len(tdi_str) < 1: raise ValueError("n must be > 0")
         if len(tdi_str) == 1 and first_tms != last_tms: raise ValueError("last_tms must be first_tms when n == 1")
 
-        tdi_str = tdi_str.copy()
-        last_tdi = tdi_str.pop()
+        # slice instead of pop(), the caller's string may be a (cached) frozenbitarray
+        last_tdi = tdi_str[-1]
+        tdi_str = tdi_str[:-1]
 
         w = bytearray()
         # NOTE: write all commands first, read results below for highest throughput,
         #       requires enough buffer size on FTDI/PC, not sure if this is an issue
 
-        i = 0
         if len(tdi_str) > 0:
             w += bytearray((Ftdi.RW_BITS_TMS_PVE_NVE, 0, (0x80 if tdi_str[0] else 0) | (1 if first_tms else 0)))
-            i += 1
-        for i in range(1, len(tdi_str), 8):
-            part = tdi_str[i:i+8].copy()
-            w += bytearray((Ftdi.RW_BITS_PVE_NVE_LSB, len(part)-1, ba2int(part)))
+            w += self._shift_commands(tdi_str[1:], Ftdi.RW_BYTES_PVE_NVE_LSB, Ftdi.RW_BITS_PVE_NVE_LSB)
         w += bytearray((Ftdi.RW_BITS_TMS_PVE_NVE, 0, (0x80 if last_tdi else 0) | (1 if last_tms else 0)))
-        self.ftdi.write_data(w)
+        self._write(w)
 
+        # every full byte returns a byte, the remaining bits and each TMS bit return a byte each; all of it is read
+        # back at once
+        nbytes, nbits = divmod(len(tdi_str) - 1, 8) if len(tdi_str) > 0 else (0, 0)
+        rd = self._read_bytes((1 if len(tdi_str) > 0 else 0) + nbytes + (1 if nbits > 0 else 0) + 1)
         r = bitarray(endian='little')
         if len(tdi_str) > 0:
-            r.append((self._read_bytes(1)[0] & 0x80) >> 7)
-        for i in range(1, len(tdi_str), 8):
-            part = tdi_str[i:i+8]
-            r += int2ba(self._read_bytes(1)[0] >> (8 - len(part)), len(part), 'little')
-        r.append((self._read_bytes(1)[0] & 0x80) >> 7)
+            r.append((rd[0] & 0x80) >> 7)
+            r.frombytes(bytes(rd[1:1+nbytes]))
+            if nbits > 0:
+                r += int2ba(rd[1+nbytes] >> (8 - nbits), nbits, 'little')
+        r.append((rd[-1] & 0x80) >> 7)
         return r
 
     def receive_tdo_str(self, n, first_tms=0, first_tdi=0, last_tms=None, last_tdi=None) -> bitarray:
@@ -132,17 +173,17 @@ class MPSSE(Driver):
             r.append(self.transfer(first_tms, first_tdi))
             n = n - 1
         while n > 256+8:
-            self.ftdi.write_data(bytearray((Ftdi.READ_BYTES_PVE_LSB, 31, 0)))
+            self._write(bytearray((Ftdi.READ_BYTES_PVE_LSB, 31, 0)))
             for x in self._read_bytes(32):
                 r += int2ba(x, 8, 'little')
             n = n - 256
         while n > 8:
-            self.ftdi.write_data(bytearray((Ftdi.READ_BYTES_PVE_LSB, 0, 0)))
+            self._write(bytearray((Ftdi.READ_BYTES_PVE_LSB, 0, 0)))
             for x in self._read_bytes(1):
                 r += int2ba(x, 8, 'little')
             n = n - 8
         if n > 1:
-            self.ftdi.write_data(bytearray((Ftdi.READ_BITS_PVE_LSB, n - 2)))
+            self._write(bytearray((Ftdi.READ_BITS_PVE_LSB, n - 2)))
             x = self._read_bytes(1)
             r += int2ba(x[0] >> (9 - n), n - 1, 'little') # TODO; is this right?
             n = 1
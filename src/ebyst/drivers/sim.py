@@ -75,7 +75,7 @@ class Sim(Driver):
                 self.shift_dr = bitarray('0', endian='little')
                 self.dr_size = len(self.device.cells)
             else:
-                logger.warning(f"Unknown IR bin({self.ir})")
+                logger.warning("Unknown IR bin(%s)", self.ir)
                 self.shift_dr = bitarray('0', endian='little')
                 self.dr_size = 1
 
@@ -140,7 +140,7 @@ class Sim(Driver):
                 next_state = State.UPDATE_IR
         elif self.state == State.UPDATE_IR:
             self.ir = self.shift_ir
-            logger.info(f"Current instruction: {self.ir}")
+            logger.info("Current instruction: %s", self.ir)
             if tms == 0:
                 next_state = State.RUN_TEST_IDLE
             elif tms == 1:
@@ -149,7 +149,7 @@ class Sim(Driver):
             assert False
 
         if self.state != next_state:
-            logger.debug(f"State {self.state.name} => {next_state.name}")
+            logger.debug("State %s => %s", self.state.name, next_state.name)
             self.state = next_state
 
         return tdo
@@ -20,6 +20,7 @@
 import asyncio
 
 from bitarray import bitarray
+from bitarray.util import zeros
 
 from ..device import Pin, PinGroup, DiffPin
 
@@ -137,22 +138,22 @@ class DDR3:
         await self.cmd_cycle()
 
         # mr2
-        mr2 = bitarray("0" * len(self.A))
+        mr2 = zeros(len(self.A))
         mr2[3:6] = bitarray("100") # CWL = 6
         await self.cmd_cycle(CSn="00", RASn=0, CASn=0, WEn=0, BA="010"[::-1], A=mr2)
         for i in range(4): await self.cmd_cycle()
         # mr3
-        mr3 = bitarray("0" * len(self.A))
+        mr3 = zeros(len(self.A))
         await self.cmd_cycle(CSn="00", RASn=0, CASn=0, WEn=0, BA="011"[::-1], A=mr3)
         for i in range(4): await self.cmd_cycle()
         # mr1
-        mr1 = bitarray("0" * len(self.A))
+        mr1 = zeros(len(self.A))
         mr1[0] = 1 # DLL = Disable
         mr1[3:5] = bitarray("00") # AL = 0
         await self.cmd_cycle(CSn="00", RASn=0, CASn=0, WEn=0, BA="001"[::-1], A=mr1)
         for i in range(4): await self.cmd_cycle()
         # mr0
-        mr0 = bitarray("0" * len(self.A))
+        mr0 = zeros(len(self.A))
         mr0[0:2] = bitarray("00") # BL = Fixed BL8
         mr0[3] = 0 # BT = Sequential
         mr0[4:7] = bitarray("010") # CL = 6
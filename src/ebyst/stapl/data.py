@@ -19,20 +19,42 @@
 # SOFTWARE.
 from binascii import hexlify
 from bitarray import bitarray
+from bitarray.util import zeros
 
 from . import errors # type: ignore
 
 class VariableScope(dict):
-    def __getitem__(self, key: str):
-        try:
-            return super().__getitem__(key)
-        except KeyError:
-            raise errors.VariableNotDefined(key) from None
+    """Variable scope; local variables are stored in the scope itself, variables which are not found locally are
+       looked up in the pushed frames (newest first)"""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.frames = []
+
+    def push_frame(self, frame: dict):
+        self.frames.append(frame)
+
+    def pop_frame(self):
+        return self.frames.pop()
+
+    def __missing__(self, key: str):
+        # only called by dict.__getitem__ for variables which are not local
+        for frame in reversed(self.frames):
+            v = dict.get(frame, key)
+            if not v is None:
+                return v
+        raise errors.VariableNotDefined(key)
+
+# scope without any variables, the default for evaluate(); evaluating an expression which uses a variable in it raises
+# VariableNotDefined, which is how constant expressions are detected
+EMPTY_SCOPE = VariableScope()
 
 class Evaluatable:
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         raise NotImplementedError()
 
+    def to_str(self, scope):
+        return str(self.evaluate(scope))
+
     def optimize(self):
         return self
 
@@ -57,7 +79,7 @@ class Variable(Evaluatable):
         assert isinstance(v, Evaluatable)
         self.v = v
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self.v.evaluate(scope)
 
 class ArrayVariable(Variable, Array):
@@ -77,7 +99,7 @@ class ArrayVariable(Variable, Array):
 
         self.v.__setitem__(slice_, v)
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self.v.evaluate(scope)
 
     def __len__(self):
@@ -100,7 +122,7 @@ class Int(Evaluatable):
         else:
             raise errors.StaplValueError(f"Could not convert {repr(v)} to Int")
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self
 
     def __add__(self, other):
@@ -180,7 +202,7 @@ class Bool(Evaluatable):
         else:
             raise errors.StaplValueError(f"Could not convert {repr(v)} to Bool")
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self
 
     def __eq__(self, other): # type: ignore
@@ -221,7 +243,7 @@ class Any(Int):
         else:
             raise errors.StaplValueError(f"Could not convert {repr(v)} to Any")
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self
 
     def __eq__(self, other):
@@ -307,7 +329,7 @@ class IntArray(list, Array):
         else:
             raise TypeError(f"Invalid type {type(i)} for slice")
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self
 
 class BoolArray(Array):
@@ -349,7 +371,7 @@ class BoolArray(Array):
             if len(v) > slice_length:
                 v = BoolArray(v.v[:slice_length])
             elif len(v) < slice_length:
-                v = BoolArray(v.v + bitarray("0", endian='little') * (slice_length - len(v)))
+                v = BoolArray(v.v + zeros(slice_length - len(v), 'little'))
 
             if i.start < i.stop:
                 self.v.__setitem__(slice(i.stop, i.start-1 if i.start > 0 else None, -1), v.v)
@@ -371,7 +393,7 @@ class BoolArray(Array):
     def __repr__(self):
         return repr(self.v)
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         return self
 
     def reverse(self):
@@ -383,7 +405,7 @@ class BoolArray(Array):
         return self.v
 
     def extend(self, length):
-        while len(self.v) < length: self.v.append(0)
+        if len(self.v) < length: self.v += zeros(length - len(self.v), 'little')
 
     def __and__(self, other):
         return self.v & other.v
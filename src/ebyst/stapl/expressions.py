@@ -17,48 +17,59 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import operator
 import pyparsing as pp
 import re
-from .data import Evaluatable, Int, Bool, BoolArray, Any, String, VariableScope
+import sys
+from .data import Evaluatable, Int, Bool, BoolArray, Any, String, EMPTY_SCOPE
 from . import aca, errors # type: ignore
 from bitarray import bitarray
 from bitarray.util import hex2ba, int2ba, ba2int
 
+LBRACK = pp.Literal("[").suppress()
+RBRACK = pp.Literal("]").suppress()
+LPAREN = pp.Literal("(").suppress()
+RPAREN = pp.Literal(")").suppress()
+DOTDOT = pp.Literal("..").suppress()
+
 class VariableRef(Evaluatable):
-    def __init__(self,  _s, _loc, tokens):
+    def __init__(self, name, slice_start=None, slice_end=None):
+        self.name = name
+        self.slice_start = slice_start
+        self.slice_end = slice_end
+
+    @staticmethod
+    def from_tokens(_s, _loc, tokens):
+        # the variant is selected once here, instead of checking the slice bounds on every evaluation
         if len(tokens) == 1:
-            self.name = tokens[0]
-            self.slice_start = None
-            self.slice_end = None
+            return VariableRef(tokens[0])
         elif len(tokens) == 2:
-            self.name = tokens[0]
-            self.slice_start = tokens[1]
-            self.slice_end = None
+            return IndexedVariableRef(tokens[0], tokens[1])
         elif len(tokens) == 3:
-            self.name = tokens[0]
-            self.slice_start = tokens[1]
-            self.slice_end = tokens[2]
+            return SlicedVariableRef(tokens[0], tokens[1], tokens[2])
         else:
-            print(tokens)
-            assert False
+            assert False, tokens
 
-    def evaluate(self, scope=VariableScope()):
-        variable = scope[self.name]
-        if not self.slice_end is None:
-            assert not self.slice_start is None
-            return variable.evaluate(scope)[slice(int(self.slice_start.evaluate(scope)), int(self.slice_end.evaluate(scope)))]
-        elif not self.slice_start is None:
-            return variable.evaluate(scope)[int(self.slice_start.evaluate(scope))].evaluate(scope)
-        else:
-            return variable.evaluate(scope)
+    def evaluate(self, scope=EMPTY_SCOPE):
+        return scope[self.name].evaluate(scope)
 
     def __str__(self):
-        if not self.slice_end is None:
-            return f"{self.name}[{self.slice_start}..{self.slice_end}]"
-        elif not self.slice_start is None:
-            return f"{self.name}[{self.slice_start}]"
-        else:
-            return self.name
+        return self.name
+
+class IndexedVariableRef(VariableRef):
+    def evaluate(self, scope=EMPTY_SCOPE):
+        return scope[self.name].evaluate(scope)[int(self.slice_start.evaluate(scope))].evaluate(scope)
+
+    def __str__(self):
+        return f"{self.name}[{self.slice_start}]"
+
+class SlicedVariableRef(VariableRef):
+    def evaluate(self, scope=EMPTY_SCOPE):
+        return scope[self.name].evaluate(scope)[slice(int(self.slice_start.evaluate(scope)),
+                                                      int(self.slice_end.evaluate(scope)))]
+
+    def __str__(self):
+        return f"{self.name}[{self.slice_start}..{self.slice_end}]"
 
 class BoolArrayParser(Evaluatable):
     def __init__(self, _s, _loc, tokens):
@@ -67,7 +78,7 @@ class BoolArrayParser(Evaluatable):
         assert self.s[0] in "#@$"
         self.ba = None
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         if self.ba is None:
             if self.s[0] == '#':
                 self.ba = bitarray(re.sub(r'\s+', '', self.s[1:]), endian='little')
@@ -83,6 +94,9 @@ class BoolArrayParser(Evaluatable):
 
         return BoolArray(self.ba)
 
+    def optimize(self):
+        return self.evaluate()
+
     def __str__(self):
         return self.s
 
@@ -91,12 +105,15 @@ class IntParser(Evaluatable):
         assert len(tokens) == 1
         self.v = int(tokens[0])
 
-    def evaluate(self, scope=VariableScope()):
+    def evaluate(self, scope=EMPTY_SCOPE):
         if self.v == 0 or self.v == 1:
             return Any(self.v)
         else:
             return Int(self.v)
 
+    def optimize(self):
+        return self.evaluate()
+
     def __str__(self):
         return str(self.v)
 
@@ -107,7 +124,7 @@ class Function(Evaluatable):
         self.function = tokens[0][0]
         self.v = tokens[0][1]
 
-    def evaluate(self, scope={}):
+    def evaluate(self, scope=EMPTY_SCOPE):
         if self.function == "BOOL":
             ba = int2ba(int(self.v.evaluate(scope)), length=32, signed=True, endian='little')
             return BoolArray(ba)
@@ -123,119 +140,119 @@ class Function(Evaluatable):
         else:
             assert False
 
-    def __str__(self):
-        return f"{self.function}({self.v})"
-
-class Expression(Evaluatable):
-    def __init__(self,  _s, _loc, tokens):
-        self.v = list(tokens)
-
     def optimize(self):
         try:
             return self.evaluate()
         except errors.VariableNotDefined:
-            if len(self.v) == 1:
-                return self.v[0].optimize()
-            else:
-                for i in range(len(self.v)):
-                    try:
-                        self.v[i] = self.v[i].optimize()
-                    except AttributeError:
-                        pass
-                return self
-
-    def evaluate(self, scope=VariableScope()):
-        if len(self.v) == 1:
-            return self.v[0].evaluate(scope)
-        elif len(self.v) == 2:
-            if self.v[0] == "~":
-                return ~Int(self.v[1].evaluate(scope))
-            elif self.v[0] == "-":
-                return -Int(self.v[1].evaluate(scope))
-            elif self.v[0] == "!":
-                return ~Bool(self.v[1].evaluate(scope))
-            else:
-                print(self)
-                assert False
-        elif len(self.v) >= 3 and (len(self.v) & 1) == 1:
-            r = self.v[0].evaluate(scope).clone()
-            for i in range(1, len(self.v), 2):
-                b = self.v[i+1].evaluate(scope)
-                if self.v[i] == "*":
-                    r *= b
-                elif self.v[i] == "/":
-                    r //= b
-                elif self.v[i] == "%":
-                    r %= b
-                elif self.v[i] == "+":
-                    r += b
-                elif self.v[i] == "-":
-                    r -= b
-                elif self.v[i] == "<<":
-                    r <<= b
-                elif self.v[i] == ">>":
-                    r >>= b
-                elif self.v[i] == "&":
-                    r &= b
-                elif self.v[i] == "^":
-                    r ^= b
-                elif self.v[i] == "|":
-                    r |= b
-                elif self.v[i] == "<=":
-                    r = r <= b
-                elif self.v[i] == "<":
-                    r = r < b
-                elif self.v[i] == ">=":
-                    r = r >= b
-                elif self.v[i] == ">":
-                    r = r > b
-                elif self.v[i] == "==":
-                    r = r == b
-                elif self.v[i] == "!=":
-                    r = r != b
-                elif self.v[i] == "&&":
-                    r = Bool(r)
-                    r &= b
-                elif self.v[i] == "||":
-                    r = Bool(r)
-                    r |= b
-                else:
-                    print(self)
-                    assert False
-            assert isinstance(r, Bool) or isinstance(r, Int) or isinstance(r, Any)
-            return r
-        else:
-            print(self.v)
-            assert False
+            return self
 
     def __str__(self):
-        return "(" + "".join([str(v) for v in self.v]) + ")"
+        return f"{self.function}({self.v})"
+
+def _logical_and(a, b):
+    return Bool(a) & b
+
+def _logical_or(a, b):
+    return Bool(a) | b
+
+def _int_invert(a):
+    return ~Int(a)
+
+def _int_negate(a):
+    return -Int(a)
+
+def _bool_not(a):
+    return ~Bool(a)
+
+UNARY_OPERATORS = {"~": _int_invert, "-": _int_negate, "!": _bool_not}
+BINARY_OPERATORS = {"*": operator.mul, "/": operator.floordiv, "%": operator.mod, "+": operator.add, "-": operator.sub,
+                    "<<": operator.lshift, ">>": operator.rshift, "&": operator.and_, "^": operator.xor,
+                    "|": operator.or_, "<=": operator.le, "<": operator.lt, ">=": operator.ge, ">": operator.gt,
+                    "==": operator.eq, "!=": operator.ne, "&&": _logical_and, "||": _logical_or}
+
+class Expression(Evaluatable):
+    """Operator expression; operands (variables, literals and functions) are not wrapped, but evaluated directly"""
+    @classmethod
+    def _reduce(cls, s, loc, tokens):
+        # precedence levels without an operator pass their operand through, instead of wrapping it once per level;
+        # chained binary operators are nested left to right
+        if len(tokens) == 1:
+            return tokens[0]
+        elif len(tokens) == 2:
+            return UnaryExpression(tokens[0], tokens[1])
+        else:
+            assert (len(tokens) & 1) == 1, tokens
+            r = tokens[0]
+            for i in range(1, len(tokens), 2):
+                r = BinaryExpression(r, tokens[i], tokens[i+1])
+            return r
 
     @classmethod
     def get_parse_rule(cls):
         expression = pp.Forward()
-        variable = (pp.Regex(r"[a-zA-Z][a-zA-Z0-9_]*") +
-                    pp.Opt(pp.Literal("[").suppress() + pp.Opt(expression + pp.Opt(pp.Literal("..").suppress() + expression)) +
-                           pp.Literal("]").suppress())).set_parse_action(VariableRef)
-        literal = pp.pyparsing_common.integer.set_parse_action(IntParser) | (pp.MatchFirst((
+        variable = (pp.Regex(r"[a-zA-Z][a-zA-Z0-9_]*").set_parse_action(lambda tokens: sys.intern(tokens[0])) +
+                    pp.Opt(LBRACK + pp.Opt(expression + pp.Opt(DOTDOT + expression)) + RBRACK)).set_parse_action(VariableRef.from_tokens)
+        # a private integer element; setting a parse action on pp.pyparsing_common.integer would change it for every
+        # other grammar (like the BSDL parser) too
+        literal = pp.Regex(r"[0-9]+").set_name("integer").set_parse_action(IntParser) | (pp.MatchFirst((
                                   pp.Regex(r"#[01\s]+"),
                                   pp.Regex(r"\$[0-9a-fA-F\s]+"),
                                   pp.Regex(r"@[^;]+")))).set_parse_action(BoolArrayParser)
         function = (pp.Group((pp.CaselessKeyword("BOOL") | pp.CaselessKeyword("INT") | pp.CaselessKeyword("CHR$")) +
-                             pp.Literal("(").suppress() + expression + pp.Literal(")").suppress())).set_parse_action(Function)
-
-        expression0 = (function | variable | literal).set_parse_action(cls)
-        expression1 = expression0 | (pp.Literal("(").suppress() - expression - pp.Literal(")").suppress())
-        expression2 = (pp.Opt(pp.one_of("- ! ~")) + expression1).set_parse_action(cls)
-        expression3 = (expression2 - pp.ZeroOrMore(pp.one_of("* / %") + expression2)).set_parse_action(cls)
-        expression4 = (expression3 - pp.ZeroOrMore(pp.one_of("+ -") + expression3)).set_parse_action(cls)
-        expression5 = (expression4 - pp.ZeroOrMore(pp.one_of("<< >>") + expression4)).set_parse_action(cls)
-        expression6 = (expression5 - pp.ZeroOrMore(pp.one_of("<= >= < >") + expression5)).set_parse_action(cls)
-        expression7 = (expression6 - pp.ZeroOrMore(pp.one_of("== !=") + expression6)).set_parse_action(cls)
-        expression8 = (expression7 - pp.ZeroOrMore(pp.Literal("&") + expression7)).set_parse_action(cls)
-        expression9 = (expression8 - pp.ZeroOrMore(pp.Literal("^") + expression8)).set_parse_action(cls)
-        expression10 = (expression9 - pp.ZeroOrMore(pp.Literal("|") + expression9)).set_parse_action(cls)
-        expression11 = (expression10 - pp.ZeroOrMore(pp.Literal("&&") + expression10)).set_parse_action(cls)
-        expression12 = (expression11 - pp.ZeroOrMore(pp.Literal("||") + expression11)).set_parse_action(cls)
-        expression <<= expression12.set_parse_action(cls, lambda _s, _loc, tokens: tokens[0].optimize()) # type: ignore
+                             LPAREN + expression + RPAREN)).set_parse_action(Function)
+
+        expression0 = function | variable | literal
+        expression1 = expression0 | (LPAREN - expression - RPAREN)
+        expression2 = (pp.Opt(pp.one_of("- ! ~")) + expression1).set_parse_action(cls._reduce)
+        expression3 = (expression2 - pp.ZeroOrMore(pp.one_of("* / %") + expression2)).set_parse_action(cls._reduce)
+        expression4 = (expression3 - pp.ZeroOrMore(pp.one_of("+ -") + expression3)).set_parse_action(cls._reduce)
+        expression5 = (expression4 - pp.ZeroOrMore(pp.one_of("<< >>") + expression4)).set_parse_action(cls._reduce)
+        expression6 = (expression5 - pp.ZeroOrMore(pp.one_of("<= >= < >") + expression5)).set_parse_action(cls._reduce)
+        expression7 = (expression6 - pp.ZeroOrMore(pp.one_of("== !=") + expression6)).set_parse_action(cls._reduce)
+        expression8 = (expression7 - pp.ZeroOrMore(pp.Literal("&") + expression7)).set_parse_action(cls._reduce)
+        expression9 = (expression8 - pp.ZeroOrMore(pp.Literal("^") + expression8)).set_parse_action(cls._reduce)
+        expression10 = (expression9 - pp.ZeroOrMore(pp.Literal("|") + expression9)).set_parse_action(cls._reduce)
+        expression11 = (expression10 - pp.ZeroOrMore(pp.Literal("&&") + expression10)).set_parse_action(cls._reduce)
+        expression12 = (expression11 - pp.ZeroOrMore(pp.Literal("||") + expression11)).set_parse_action(cls._reduce)
+        expression <<= expression12.set_parse_action(cls._reduce, lambda _s, _loc, tokens: tokens[0].optimize()) # type: ignore
         return expression
+
+class UnaryExpression(Expression):
+    def __init__(self, op, v):
+        self.op = op
+        self.function = UNARY_OPERATORS[op]
+        self.v = v
+
+    def optimize(self):
+        try:
+            return self.evaluate()
+        except errors.VariableNotDefined:
+            self.v = self.v.optimize()
+            return self
+
+    def evaluate(self, scope=EMPTY_SCOPE):
+        return self.function(self.v.evaluate(scope))
+
+    def __str__(self):
+        return f"({self.op}{self.v})"
+
+class BinaryExpression(Expression):
+    def __init__(self, lhs, op, rhs):
+        self.lhs = lhs
+        self.op = op
+        self.function = BINARY_OPERATORS[op]
+        self.rhs = rhs
+
+    def optimize(self):
+        try:
+            return self.evaluate()
+        except errors.VariableNotDefined:
+            self.lhs = self.lhs.optimize()
+            self.rhs = self.rhs.optimize()
+            return self
+
+    def evaluate(self, scope=EMPTY_SCOPE):
+        return self.function(self.lhs.evaluate(scope), self.rhs.evaluate(scope))
+
+    def __str__(self):
+        return f"({self.lhs}{self.op}{self.rhs})"
@@ -20,7 +20,7 @@
 import logging
 
 from ..tap_controller import State
-from .data import Variable, Evaluatable, Int, IntArray, Bool, BoolArray, CheckedVariableScope, ArrayVariable
+from .data import Variable, Int, IntArray, Bool, BoolArray, CheckedVariableScope, ArrayVariable
 from .stapl import (AssignmentInstruction, BooleanInstruction, CallInstruction, DataInstruction, DrScanInstruction,
                     DrStopInstruction, EndDataInstruction, EndProcedureInstruction, ExitInstruction, ExportInstruction,
                     ForInstruction, GotoInstruction, IfInstruction, IntegerInstruction, IrScanInstruction,
@@ -35,8 +35,34 @@ class StaplExitCode(errors.StaplError):
     def __init__(self, code=0):
         self.code = code
 
+# returned by StaplInterpreter.execute when the procedure (or data block) ended, or an EXIT instruction was executed
+END = object()
+EXIT = object()
+
+# states in which a scan may end
+STABLE_STATES = frozenset((State.TEST_LOGIC_RESET, State.RUN_TEST_IDLE, State.PAUSE_IR, State.PAUSE_DR))
+
+class _DataScopes(dict):
+    """Data block scopes, a data block is only initialized when it is used for the first time"""
+    def __init__(self, interpreter):
+        dict.__init__(self)
+        self.interpreter = interpreter
+
+    def get(self, name, default=None):
+        try:
+            return dict.__getitem__(self, name)
+        except KeyError:
+            pass
+        pc = self.interpreter.stapl.data_blocks.get(name)
+        if pc is None:
+            return default
+        scope = self[name] = self.interpreter._init_data(name, pc)
+        return scope
+
 class StaplInterpreter:
     class State:
+        __slots__ = ("pc", "procedure", "loop_stack", "scope", "stack")
+
         def __init__(self, pc, procedure):
             self.pc = pc
             self.procedure = procedure
@@ -44,247 +70,318 @@ class StaplInterpreter:
             self.scope = CheckedVariableScope()
             self.stack = []
 
+        def reset(self, pc, procedure):
+            """Reinitialize a finished state, so it can be reused"""
+            self.pc = pc
+            self.procedure = procedure
+            self.loop_stack.clear()
+            self.scope.clear()
+            self.scope.frames.clear()
+            self.stack.clear()
+
     def __init__(self, ctl, stapl):
         self.stapl = stapl
         self.ctl = ctl
         self.call_stack = []
-        self.data_scopes = {}
+        self.free_states = [] # states of returned procedure calls, for reuse
+        self.data_scopes = _DataScopes(self)
         self.state = None
+        self.exit_code = None
         self.ir_stop = State.RUN_TEST_IDLE
         self.dr_stop = State.RUN_TEST_IDLE
-
-    def _assign(self, variable, value):
-        assert not self.state is None
-        if not variable.last is None:
-            assert not variable.first is None
-            first = int(variable.first.evaluate(self.state.scope))
-            last = int(variable.last.evaluate(self.state.scope))
-            logger.debug("Setting %s[%d:%d] to %s", variable.name, first, last, value)
-            self.state.scope[variable.name].assign(slice(first, last), value)
-        elif not variable.first is None:
-            first = int(variable.first.evaluate(self.state.scope))
-            logger.debug("Setting %s[%d] to %s", variable.name, first, value)
-            self.state.scope[variable.name].assign(first, value)
-        else:
-            logger.debug("Setting %s to %s", variable.name, value)
-            self.state.scope[variable.name].assign(value)
+        self.handlers = {
+            AssignmentInstruction: self._assignment,
+            BooleanInstruction: self._boolean,
+            CallInstruction: self._call,
+            DataInstruction: self._data,
+            DrScanInstruction: self._dr_scan,
+            DrStopInstruction: self._dr_stop,
+            EndDataInstruction: self._end_data,
+            EndProcedureInstruction: self._end_procedure,
+            ExitInstruction: self._exit,
+            ExportInstruction: self._export,
+            ForInstruction: self._for,
+            FrequencyInstruction: self._frequency,
+            GotoInstruction: self._goto,
+            IfInstruction: self._if,
+            IntegerInstruction: self._integer,
+            IrScanInstruction: self._ir_scan,
+            IrStopInstruction: self._ir_stop,
+            NextInstruction: self._next,
+            PopInstruction: self._pop,
+            PrintInstruction: self._print,
+            ProcedureInstruction: self._procedure,
+            PushInstruction: self._push,
+            StateInstruction: self._state,
+            TRSTInstruction: self._trst,
+            WaitInstruction: self._wait,
+        }
+        # handler of every statement, resolved once instead of on every execution
+        self.program = tuple(self.handlers.get(type(instruction), self._not_implemented)
+                             for instruction in stapl.statements)
 
     def execute(self, instruction=None):
+        """Execute a single instruction (the instruction at pc if instruction is None); returns None, or END/EXIT when
+           the procedure or data block ended or an EXIT instruction was executed"""
         assert not self.state is None
         if instruction is None:
             assert self.state.pc < len(self.stapl.statements)
-            instruction = self.stapl.statements[self.state.pc].instruction
+            instruction = self.stapl.statements[self.state.pc]
             self.state.pc += 1
 
         logger.debug("%d: %s", instruction.line, instruction)
 
-        if isinstance(instruction, AssignmentInstruction):
-            self._assign(instruction.variable, instruction.value.evaluate(self.state.scope))
-        elif isinstance(instruction, BooleanInstruction):
-            if instruction.length is None:
-                if instruction.value is None:
-                    v = Bool(0)
-                else:
-                    v = instruction.value.evaluate(self.state.scope)
-                var = Variable(v)
-            else:
-                if not instruction.value is None:
-                    v = instruction.value.evaluate()
-                else:
-                    v = BoolArray([0] * instruction.length)
-                var = ArrayVariable(v)
-            self.state.scope[instruction.name] = var
-            logger.debug("Setting %s to %s...", instruction.name, v)
-        elif isinstance(instruction, CallInstruction):
-            self.call_stack.append(self.state)
-            self.state = StaplInterpreter.State(self.stapl.procedures[instruction.procedure], instruction.procedure)
-        elif isinstance(instruction, DataInstruction):
-            pass
-        elif isinstance(instruction, DrScanInstruction):
-            in_array = instruction.data_array.evaluate(self.state.scope)
-            length = int(instruction.length.evaluate(self.state.scope))
-            if len(in_array) < length:
-                in_array.extend(length)
-            elif len(in_array) > length:
-                in_array = in_array[length-1:0]
-            out_array = self.ctl.dr_scan(in_array.to_bitarray(), self.dr_stop)
-            out_array = BoolArray(out_array)
-            if not instruction.capture_array is None:
-                self._assign(instruction.capture_array, out_array)
-            if not instruction.compare_array is None:
-                compare_array = instruction.compare_array.evaluate(self.state.scope)
-                compare_mask_array = instruction.compare_mask_array.evaluate(self.state.scope)
-                if out_array & compare_mask_array == compare_array & compare_mask_array:
-                    self._assign(instruction.compare_result, Bool(1))
-                else:
-                    self._assign(instruction.compare_result, Bool(0))
-        elif isinstance(instruction, DrStopInstruction):
-            if instruction.state in (State.TEST_LOGIC_RESET, State.RUN_TEST_IDLE, State.PAUSE_IR, State.PAUSE_DR):
-                self.dr_stop = instruction.state
-            else:
-                raise errors.InvalidState(instruction.state.name)
-        elif isinstance(instruction, EndDataInstruction):
-            return False
-        elif isinstance(instruction, EndProcedureInstruction):
-            if len(self.call_stack) > 0:
-                self.state = self.call_stack.pop()
-            else:
-                return False
-        elif isinstance(instruction, ExitInstruction):
-            raise StaplExitCode(instruction.exit_code.evaluate(self.state.scope))
-        elif isinstance(instruction, ExportInstruction):
-            s = ""
-            for part in instruction.parts:
-                if isinstance(part, Evaluatable):
-                    s += str(part.evaluate(self.state.scope))
-                else:
-                    s += str(part)
-            logger.debug("EXPORT %s: %s", instruction.key, s)
-            self.ctl.export(instruction.key, s)
-        elif isinstance(instruction, ForInstruction):
-            start = instruction.start.evaluate(self.state.scope)
-            step = instruction.step.evaluate(self.state.scope)
-            end = instruction.end.evaluate(self.state.scope)
-            self.state.loop_stack.append((instruction.var, step, end, self.state.pc))
-            self.state.scope[instruction.var] = var = Variable(start)
-        elif isinstance(instruction, FrequencyInstruction):
-            self.ctl.set_frequency(int(instruction.frequency.evaluate(self.state.scope)))
-        elif isinstance(instruction, GotoInstruction):
-            try:
-                assert not self.state.procedure is None
-                self.state.pc = self.stapl.labels[self.state.procedure][instruction.label]
-            except KeyError:
-                raise errors.LabelNotDefined(instruction.label)
-        elif isinstance(instruction, IfInstruction):
-            v = instruction.condition.evaluate(self.state.scope)
-            if Bool(v):
-                self.execute(instruction.instruction)
-        elif isinstance(instruction, IntegerInstruction):
-            if instruction.length is None:
-                if instruction.value is None:
-                    v = Int(0)
-                else:
-                    v = instruction.value.evaluate(self.state.scope)
-                var = Variable(v)
+        return self.handlers.get(type(instruction), self._not_implemented)(instruction)
+
+    def _not_implemented(self, instruction):
+        raise NotImplementedError(f"{instruction} not implemented")
+
+    def _assignment(self, instruction):
+        instruction.variable.assign(self.state.scope, instruction.value.evaluate(self.state.scope))
+
+    def _boolean(self, instruction):
+        if instruction.length is None:
+            if instruction.value is None:
+                v = Bool(0)
             else:
-                assert isinstance(instruction.value, IntArray)
-                v = IntArray([0] * instruction.length)
-                if not instruction.value is None:
-                    for i in range(instruction.length):
-                        v[i] = instruction.value[i].evaluate(self.state.scope)
-                var = ArrayVariable(v)
-            self.state.scope[instruction.name] = var
-            logger.debug("Setting %s to %s...", instruction.name, v)
-        elif isinstance(instruction, IrScanInstruction):
-            in_array = instruction.data_array.evaluate(self.state.scope)
-            length = int(instruction.length.evaluate(self.state.scope))
-            if len(in_array) < length:
-                raise errors.StaplError(f"Instruction array of size {len(in_array)} doesn't match length {instruction.length}")
-            if len(in_array) != length:
-                in_array = in_array[length-1:0]
-            out_array = self.ctl.ir_scan(in_array.to_bitarray(), self.ir_stop)
-            out_array = BoolArray(out_array)
-            if not instruction.capture_array is None:
-                self._assign(instruction.capture_array, out_array)
-            if not instruction.compare_array is None:
-                compare_array = instruction.compare_array.evaluate(self.state.scope)
-                compare_mask_array = instruction.compare_mask_array.evaluate(self.state.scope)
-                if out_array & compare_mask_array == compare_array & compare_mask_array:
-                    self._assign(instruction.compare_result, Bool(1))
-                else:
-                    self._assign(instruction.compare_result, Bool(0))
-        elif isinstance(instruction, IrStopInstruction):
-            if instruction.state in (State.TEST_LOGIC_RESET, State.RUN_TEST_IDLE, State.PAUSE_IR, State.PAUSE_DR):
-                self.ir_stop = instruction.state
+                v = instruction.value.evaluate(self.state.scope)
+            var = Variable(v)
+        else:
+            if not instruction.value is None:
+                v = instruction.value.evaluate(self.state.scope)
             else:
-                raise errors.InvalidState(instruction.state.name)
-        elif isinstance(instruction, NextInstruction):
-            if len(self.state.loop_stack) == 0:
-                raise errors.StaplError("NEXT without FOR")
-            var, step, end, first_pc = self.state.loop_stack[-1]
-            if instruction.var != var:
-                raise errors.StaplError(f"NEXT variable {instruction.var} doesn't match FOR variable {var}")
-            var = self.state.scope[var]
-            cur = var.evaluate()
-            if (Int(step) > 0 and cur < end) or (Int(step) < 0 and cur > end):
-                var.assign(cur + step)
-                self.state.pc = first_pc
+                v = BoolArray([0] * instruction.length)
+            var = ArrayVariable(v)
+        self.state.scope[instruction.name] = var
+        logger.debug("Setting %s to %s...", instruction.name, v)
+
+    def _call(self, instruction):
+        if instruction.pc is None:
+            raise errors.StaplError(f"Procedure {instruction.procedure} not found")
+        self.call_stack.append(self.state)
+        if len(self.free_states) > 0:
+            self.state = self.free_states.pop()
+            self.state.reset(instruction.pc, instruction.procedure)
+        else:
+            self.state = StaplInterpreter.State(instruction.pc, instruction.procedure)
+
+    def _data(self, instruction):
+        pass
+
+    def _dr_scan(self, instruction):
+        in_array = instruction.data_array.evaluate(self.state.scope)
+        length = int(instruction.length.evaluate(self.state.scope))
+        if len(in_array) < length:
+            in_array.extend(length)
+        elif len(in_array) > length:
+            in_array = in_array[length-1:0]
+        out_array = self.ctl.dr_scan(in_array.to_bitarray(), self.dr_stop)
+        out_array = BoolArray(out_array)
+        if not instruction.capture_array is None:
+            instruction.capture_array.assign(self.state.scope, out_array)
+        if not instruction.compare_array is None:
+            compare_array = instruction.compare_array.evaluate(self.state.scope)
+            compare_mask_array = instruction.compare_mask_array.evaluate(self.state.scope)
+            if out_array & compare_mask_array == compare_array & compare_mask_array:
+                instruction.compare_result.assign(self.state.scope, Bool(1))
             else:
-                self.state.loop_stack.pop()
-        elif isinstance(instruction, PopInstruction):
-            v = self.state.stack.pop()
-            self._assign(instruction.variable, v)
-        elif isinstance(instruction, PrintInstruction):
-            s = ""
-            for part in instruction.parts:
-                if isinstance(part, Evaluatable):
-                    s += str(part.evaluate(self.state.scope))
-                else:
-                    s += str(part)
-            print(s)
-
-        elif isinstance(instruction, ProcedureInstruction):
-            assert len(self.state.scope) == 0
-            for dep in instruction.uses:
-                proc = self.stapl.procedures.get(dep)
-                data = self.data_scopes.get(dep)
-                if (proc is None) and (data is None):
-                    raise errors.StaplError("Dependency {dep} not found for procedure {instruction.name}")
-                elif not ((proc is None) or (data is None)):
-                    raise errors.StaplError("Dependency {dep} is ambiguous for procedure {instruction.name}")
-                if not data is None:
-                    self.state.scope.update(data)
-        elif isinstance(instruction, PushInstruction):
-            self.state.stack.append(instruction.value.evaluate(self.state.scope))
-        elif isinstance(instruction, StateInstruction):
-            for state in instruction.states:
-                self.ctl.enter_state(state)
-        elif isinstance(instruction, TRSTInstruction):
-            self.ctl.trst(cycles=int(instruction.wait_cycles.evaluate(self.state.scope)),
-                          usec=int(instruction.wait_usec.evaluate(self.state.scope)))
-        elif isinstance(instruction, WaitInstruction):
-            if not instruction.wait_state is None:
-                self.ctl.enter_state(instruction.wait_state)
+                instruction.compare_result.assign(self.state.scope, Bool(0))
+
+    def _dr_stop(self, instruction):
+        if instruction.state in STABLE_STATES:
+            self.dr_stop = instruction.state
+        else:
+            raise errors.InvalidState(instruction.state.name)
+
+    def _end_data(self, instruction):
+        return END
+
+    def _end_procedure(self, instruction):
+        if len(self.call_stack) > 0:
+            self.free_states.append(self.state)
+            self.state = self.call_stack.pop()
+        else:
+            return END
+
+    def _exit(self, instruction):
+        self.exit_code = instruction.exit_code.evaluate(self.state.scope)
+        return EXIT
+
+    def _export(self, instruction):
+        scope = self.state.scope
+        s = instruction.template.format(*[part.to_str(scope) for part in instruction.parts])
+        logger.debug("EXPORT %s: %s", instruction.key, s)
+        self.ctl.export(instruction.key, s)
+
+    def _for(self, instruction):
+        start = instruction.start.evaluate(self.state.scope)
+        # step and end are fixed for the whole loop, NEXT compares them as plain integers
+        step = Int(instruction.step.evaluate(self.state.scope)).v
+        end = Int(instruction.end.evaluate(self.state.scope)).v
+        self.state.loop_stack.append((instruction.var, step, end, self.state.pc))
+        self.state.scope[instruction.var] = var = Variable(start)
+
+    def _frequency(self, instruction):
+        self.ctl.set_frequency(int(instruction.frequency.evaluate(self.state.scope)))
+
+    def _goto(self, instruction):
+        if instruction.pc is None:
+            raise errors.LabelNotDefined(instruction.label)
+        self.state.pc = instruction.pc
+
+    def _if(self, instruction):
+        if instruction.constant is None:
+            condition = Bool(instruction.condition.evaluate(self.state.scope))
+        else:
+            condition = instruction.constant
+        if condition:
+            return self.execute(instruction.instruction)
+
+    def _integer(self, instruction):
+        if instruction.length is None:
+            if instruction.value is None:
+                v = Int(0)
             else:
-                self.ctl.enter_state(State.RUN_TEST_IDLE)
-            self.ctl.wait(cycles=int(instruction.wait_cycles.evaluate(self.state.scope)),
-                          usec=int(instruction.wait_usec.evaluate(self.state.scope)))
-            if not instruction.end_state is None:
-                self.ctl.enter_state(instruction.end_state)
+                v = instruction.value.evaluate(self.state.scope)
+            var = Variable(v)
+        else:
+            assert isinstance(instruction.value, IntArray)
+            v = IntArray([0] * instruction.length)
+            if not instruction.value is None:
+                for i in range(instruction.length):
+                    v[i] = instruction.value[i].evaluate(self.state.scope)
+            var = ArrayVariable(v)
+        self.state.scope[instruction.name] = var
+        logger.debug("Setting %s to %s...", instruction.name, v)
+
+    def _ir_scan(self, instruction):
+        in_array = instruction.data_array.evaluate(self.state.scope)
+        length = int(instruction.length.evaluate(self.state.scope))
+        if len(in_array) < length:
+            raise errors.StaplError(f"Instruction array of size {len(in_array)} doesn't match length {instruction.length}")
+        if len(in_array) != length:
+            in_array = in_array[length-1:0]
+        out_array = self.ctl.ir_scan(in_array.to_bitarray(), self.ir_stop)
+        out_array = BoolArray(out_array)
+        if not instruction.capture_array is None:
+            instruction.capture_array.assign(self.state.scope, out_array)
+        if not instruction.compare_array is None:
+            compare_array = instruction.compare_array.evaluate(self.state.scope)
+            compare_mask_array = instruction.compare_mask_array.evaluate(self.state.scope)
+            if out_array & compare_mask_array == compare_array & compare_mask_array:
+                instruction.compare_result.assign(self.state.scope, Bool(1))
             else:
-                self.ctl.enter_state(State.RUN_TEST_IDLE)
+                instruction.compare_result.assign(self.state.scope, Bool(0))
+
+    def _ir_stop(self, instruction):
+        if instruction.state in STABLE_STATES:
+            self.ir_stop = instruction.state
+        else:
+            raise errors.InvalidState(instruction.state.name)
+
+    def _next(self, instruction):
+        if len(self.state.loop_stack) == 0:
+            raise errors.StaplError("NEXT without FOR")
+        var, step, end, first_pc = self.state.loop_stack[-1]
+        if instruction.var != var:
+            raise errors.StaplError(f"NEXT variable {instruction.var} doesn't match FOR variable {var}")
+        var = self.state.scope[var]
+        cur = Int(var.evaluate(self.state.scope)).v
+        if (step > 0 and cur < end) or (step < 0 and cur > end):
+            var.assign(Int(cur + step))
+            self.state.pc = first_pc
         else:
-            raise NotImplementedError(f"{instruction} not implemented")
+            self.state.loop_stack.pop()
+
+    def _pop(self, instruction):
+        v = self.state.stack.pop()
+        instruction.variable.assign(self.state.scope, v)
+
+    def _print(self, instruction):
+        scope = self.state.scope
+        print(instruction.template.format(*[part.to_str(scope) for part in instruction.parts]))
+
+    def _procedure(self, instruction):
+        assert len(self.state.scope) == 0
+        for dep in instruction.uses:
+            proc = self.stapl.procedures.get(dep)
+            data = self.data_scopes.get(dep)
+            if not self.exit_code is None:
+                # EXIT in the data block's initialization, stop the procedure (and its callers)
+                return EXIT
+            if (proc is None) and (data is None):
+                raise errors.StaplError("Dependency {dep} not found for procedure {instruction.name}")
+            elif not ((proc is None) or (data is None)):
+                raise errors.StaplError("Dependency {dep} is ambiguous for procedure {instruction.name}")
+            if not data is None:
+                self.state.scope.push_frame(data)
 
-        return True
+    def _push(self, instruction):
+        self.state.stack.append(instruction.value.evaluate(self.state.scope))
+
+    def _state(self, instruction):
+        for state in instruction.states:
+            self.ctl.enter_state(state)
+
+    def _trst(self, instruction):
+        self.ctl.trst(cycles=int(instruction.wait_cycles.evaluate(self.state.scope)),
+                      usec=int(instruction.wait_usec.evaluate(self.state.scope)))
+
+    def _wait(self, instruction):
+        if not instruction.wait_state is None:
+            self.ctl.enter_state(instruction.wait_state)
+        else:
+            self.ctl.enter_state(State.RUN_TEST_IDLE)
+        self.ctl.wait(cycles=int(instruction.wait_cycles.evaluate(self.state.scope)),
+                      usec=int(instruction.wait_usec.evaluate(self.state.scope)))
+        if not instruction.end_state is None:
+            self.ctl.enter_state(instruction.end_state)
+        else:
+            self.ctl.enter_state(State.RUN_TEST_IDLE)
 
     def _run_procedure(self, pc, procedure=None):
         self.state = StaplInterpreter.State(pc, procedure)
-        done = False
-        while not done:
+        statements = self.stapl.statements
+        program = self.program
+        debug = logger.isEnabledFor(logging.DEBUG)
+        while True:
+            # self.state changes when a procedure is called or returns
+            state = self.state
+            i = state.pc
+            state.pc = i + 1
+            instruction = statements[i]
+            if debug: logger.debug("%d: %s", instruction.line, instruction)
             try:
-                done = not self.execute()
+                rc = program[i](instruction)
             except errors.StaplError as e:
                 e.pc = pc
                 raise
+            if not rc is None:
+                break
         state = self.state
         self.state = None
         return state
 
+    def _init_data(self, name, pc):
+        state = self.state
+        logger.debug("Initializing %s...", name)
+        scope = self._run_procedure(pc).scope
+        logger.debug("Data %s initialized", name)
+        self.state = state
+        return scope
+
     def run(self, action, recommended=True, optional=False):
         self.ir_stop = State.RUN_TEST_IDLE
         self.dr_stop = State.RUN_TEST_IDLE
+        self.exit_code = None
 
         which = ["required"]
         if recommended: which.append("recommended")
         if optional: which.append("optional")
 
-        for name, pc in self.stapl.data_blocks.items():
-            logger.debug("Initializing %s...", name)
-            self.data_scopes[name] = self._run_procedure(pc).scope
-            logger.debug("Data %s initialized", name)
+        self.data_scopes = _DataScopes(self)
 
-        logger.info(f"Running action {action}...")
+        logger.info("Running action %s...", action)
         try:
             action = self.stapl.actions[action]
         except KeyError:
@@ -296,12 +393,11 @@ class StaplInterpreter:
                 except KeyError:
                     raise errors.StaplError(f"Procedure {procedure} not found") from None
                 else:
-                    try:
-                        self._run_procedure(pc, procedure)
-                    except StaplExitCode as e:
-                        if e.code == 0:
+                    self._run_procedure(pc, procedure)
+                    if not self.exit_code is None:
+                        if int(self.exit_code) == 0:
                             break
                         else:
-                            raise
-        logger.info(f"Action completed")
+                            raise StaplExitCode(self.exit_code)
+        logger.info("Action completed")
 
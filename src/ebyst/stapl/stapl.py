@@ -17,16 +17,51 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import binascii
 import logging
+import os
+import re
+import sys
 import pyparsing as pp
 
-from .data import Int, IntArray
-from .expressions import Expression
+from .data import Evaluatable, Int, Bool, IntArray, BoolArray
+from .expressions import Expression, LBRACK, RBRACK, DOTDOT
+from . import errors # type: ignore
 from ..tap_controller import State
+from ..cache import PickleCache
 
 logger = logging.getLogger(__name__)
 
+SEMI = pp.Literal(";").suppress()
+COMMA = pp.Literal(",").suppress()
+EQ = pp.Literal("=").suppress()
+COLON = pp.Literal(":").suppress()
+KW_CAPTURE = pp.CaselessKeyword("CAPTURE")
+KW_COMPARE = pp.CaselessKeyword("COMPARE")
+KW_CYCLES = pp.CaselessKeyword("CYCLES")
+KW_USEC = pp.CaselessKeyword("USEC")
+
+class _KeywordSwitch(pp.ParseExpression):
+    """Selects the alternative to parse by the leading keyword, alternatives are given as a keyword -> element dict; if
+       the statement doesn't start with one of the keywords, default is parsed"""
+    WORD = re.compile(r"[a-zA-Z][a-zA-Z0-9_]*")
+
+    def __init__(self, alternatives, default):
+        super().__init__(list(alternatives.values()) + [default])
+        self.alternatives = {keyword.upper(): e for keyword, e in alternatives.items()}
+        self.default = default
+        self.mayReturnEmpty = False
+
+    def parseImpl(self, instring, loc, do_actions=True):
+        m = self.WORD.match(instring, loc)
+        if not m is None:
+            e = self.alternatives.get(m.group(0).upper())
+            if not e is None:
+                return e._parse(instring, loc, do_actions)
+        return self.default._parse(instring, loc, do_actions)
+
 class Note:
+    __slots__ = ("key", "text")
     def __init__(self,  _s, _loc, tokens):
         assert len(tokens) == 2
         self.key = tokens[0]
@@ -36,6 +71,7 @@ class Note:
         return f"{self.key}: {self.text}"
 
 class Action:
+    __slots__ = ("name", "text", "procedures")
     def __init__(self,  _s, _loc, tokens):
         self.name = tokens[0]
         self.text = tokens[1][0] if len(tokens[1]) > 0 else tokens[0]
@@ -51,6 +87,7 @@ class Action:
         return f"ACTION {self.name}"
 
 class VariableDecl:
+    __slots__ = ("name", "length")
     def __init__(self,  _s, _loc, tokens):
         self.name = tokens[0]
         if len(tokens) > 1:
@@ -65,6 +102,7 @@ class VariableDecl:
             return f"{self.name}[{self.length}]"
 
 class Variable:
+    __slots__ = ("name", "first", "last", "assign")
     def __init__(self,  s, loc, tokens):
         if len(tokens) == 1:
             self.name = tokens[0]
@@ -81,41 +119,64 @@ class Variable:
         else:
             assert False
 
+        # select assignment variant once, instead of on every assignment
+        if not self.last is None:
+            self.assign = self._assign_slice
+        elif not self.first is None:
+            self.assign = self._assign_index
+        else:
+            self.assign = self._assign_scalar
+
+    def _assign_scalar(self, scope, value):
+        logger.debug("Setting %s to %s", self.name, value)
+        scope[self.name].assign(value)
+
+    def _assign_index(self, scope, value):
+        first = int(self.first.evaluate(scope))
+        logger.debug("Setting %s[%d] to %s", self.name, first, value)
+        scope[self.name].assign(first, value)
+
+    def _assign_slice(self, scope, value):
+        first = int(self.first.evaluate(scope))
+        last = int(self.last.evaluate(scope))
+        logger.debug("Setting %s[%d:%d] to %s", self.name, first, last, value)
+        scope[self.name].assign(slice(first, last), value)
+
     def __str__(self):
         return self.name
 
 class Instruction:
+    __slots__ = ("line", "col")
     def __init__(self,  s, loc, tokens):
         self.line = pp.lineno(loc, s)
         self.col = pp.col(loc, s)
 
 class LabelledInstruction(Instruction):
+    __slots__ = ("label", "instruction")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 2
         self.label = tokens[0][0] if len(tokens[0]) > 0 else None
         self.instruction = tokens[1]
 
-    def execute(self, interpreter):
-        return self.instruction.execute(interpreter)
-
     def __str__(self):
         return f"{self.label}: {self.instruction}"
 
 class AssignmentInstruction(Instruction):
+    __slots__ = ("variable", "value")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         if len(tokens) == 2:
             self.variable = tokens[0]
             self.value = tokens[1]
         else:
-            print(tokens)
-            assert False
+            assert False, tokens
 
     def __str__(self):
         return f"{self.variable.name} = {self.value}"
 
 class BooleanInstruction(Instruction):
+    __slots__ = ("name", "length", "value")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.name = tokens[0].name
@@ -129,15 +190,18 @@ class BooleanInstruction(Instruction):
         return f"BOOLEAN {self.name}"
 
 class CallInstruction(Instruction):
+    __slots__ = ("procedure", "pc")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 1
         self.procedure = tokens[0]
+        self.pc = None # resolved by StaplFile
 
     def __str__(self):
         return f"CALL {self.procedure}"
 
 class ScanInstruction(Instruction):
+    __slots__ = ("length", "data_array", "capture_array", "compare_array", "compare_mask_array", "compare_result")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.length = tokens[0]
@@ -155,15 +219,17 @@ class ScanInstruction(Instruction):
             i += 4
         else:
             self.compare_array = None
-            self.mask_array = None
+            self.compare_mask_array = None
             self.compare_result = None
         assert i == len(tokens)
 
 class DrScanInstruction(ScanInstruction):
+    __slots__ = ()
     def __str__(self):
         return f"DRSCAN {self.length}"
 
 class DrStopInstruction(Instruction):
+    __slots__ = ("state",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 1
@@ -173,6 +239,7 @@ class DrStopInstruction(Instruction):
         return f"IRSTOP {self.state}"
 
 class ExitInstruction(Instruction):
+    __slots__ = ("exit_code",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.exit_code = tokens[0]
@@ -180,16 +247,31 @@ class ExitInstruction(Instruction):
     def __str__(self):
         return f"EXIT {self.exit_code}"
 
+def _fold_parts(parts):
+    """Fold PRINT/EXPORT parts into a format template; constant parts are put in the template, the parts which have to
+       be evaluated are returned with a {} placeholder for each of them"""
+    template = []
+    variable_parts = []
+    for part in parts:
+        if not isinstance(part, Evaluatable) or isinstance(part, (Int, Bool, BoolArray)):
+            template.append(str(part).replace("{", "{{").replace("}", "}}"))
+        else:
+            template.append("{}")
+            variable_parts.append(part)
+    return "".join(template), tuple(variable_parts)
+
 class ExportInstruction(Instruction):
+    __slots__ = ("key", "template", "parts")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.key = tokens[0]
-        self.parts = tokens[1:]
+        self.template, self.parts = _fold_parts(tokens[1:])
 
     def __repr__(self):
-        return f"EXPORT {', '.join(str(s) for s in self.parts)}"
+        return f"EXPORT {self.key}, {self.template.format(*self.parts)}"
 
 class FrequencyInstruction(Instruction):
+    __slots__ = ("frequency",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.frequency = tokens[0]
@@ -198,23 +280,35 @@ class FrequencyInstruction(Instruction):
         return f"FREQUENCY {self.frequency}"
 
 class GotoInstruction(Instruction):
+    __slots__ = ("label", "pc")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.label = tokens[1]
+        self.pc = None # resolved by StaplFile
 
     def __str__(self):
         return f"GOTO {self.label}"
 
 class IfInstruction(Instruction):
+    __slots__ = ("condition", "instruction", "constant")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.condition = tokens[0]
         self.instruction = tokens[1]
 
+        # conditions which were folded to a constant by the expression parser are resolved here, once
+        self.constant = None
+        if isinstance(self.condition, (Int, Bool)):
+            try:
+                self.constant = bool(Bool(self.condition))
+            except errors.StaplValueError:
+                pass
+
     def __str__(self):
         return f"IF {self.condition} THEN {self.instruction}"
 
 class IntegerInstruction(Instruction):
+    __slots__ = ("name", "length", "value")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         self.name = tokens[0].name
@@ -242,10 +336,12 @@ class IntegerInstruction(Instruction):
         return f"INTEGER {self.name}"
 
 class IrScanInstruction(ScanInstruction):
+    __slots__ = ()
     def __str__(self):
         return f"IRSCAN {self.length}"
 
 class IrStopInstruction(Instruction):
+    __slots__ = ("state",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 1
@@ -255,6 +351,7 @@ class IrStopInstruction(Instruction):
         return f"IRSTOP {self.state}"
 
 class PopInstruction(Instruction):
+    __slots__ = ("variable",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         if len(tokens) == 1:
@@ -266,14 +363,16 @@ class PopInstruction(Instruction):
         return f"POP {self.variable}"
 
 class PrintInstruction(Instruction):
+    __slots__ = ("template", "parts")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
-        self.parts = tokens
+        self.template, self.parts = _fold_parts(tokens)
 
     def __str__(self):
-        return f"PRINT {', '.join(str(s) for s in self.parts)}"
+        return f"PRINT {self.template.format(*self.parts)}"
 
 class PushInstruction(Instruction):
+    __slots__ = ("value",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 1
@@ -283,52 +382,41 @@ class PushInstruction(Instruction):
         return f"PUSH {self.value}"
 
 class StateConvert:
+    __slots__ = ("state",)
+    STATES = {
+        "RESET": State.TEST_LOGIC_RESET,
+        "IDLE": State.RUN_TEST_IDLE,
+        "DRSELECT": State.SELECT_DR_SCAN,
+        "DRCAPTURE": State.CAPTURE_DR,
+        "DRSHIFT": State.SHIFT_DR,
+        "DREXIT1": State.EXIT1_DR,
+        "DRPAUSE": State.PAUSE_DR,
+        "DREXIT2": State.EXIT2_DR,
+        "DRUPDATE": State.UPDATE_DR,
+        "IRSELECT": State.SELECT_IR_SCAN,
+        "IRCAPTURE": State.CAPTURE_IR,
+        "IRSHIFT": State.SHIFT_IR,
+        "IREXIT1": State.EXIT1_IR,
+        "IRPAUSE": State.PAUSE_IR,
+        "IREXIT2": State.EXIT2_IR,
+        "IRUPDATE": State.UPDATE_IR,
+    }
+
     def __init__(self,  s, loc, tokens):
         assert len(tokens) == 1
-        if tokens[0] == "RESET":
-            self.state = State.TEST_LOGIC_RESET
-        elif tokens[0] == "IDLE":
-            self.state = State.RUN_TEST_IDLE
-        elif tokens[0] == "DRSELECT":
-            self.state = State.SELECT_DR_SCAN
-        elif tokens[0] == "DRCAPTURE":
-            self.state = State.CAPTURE_DR
-        elif tokens[0] == "DRSHIFt":
-            self.state = State.SHIFT_DR
-        elif tokens[0] == "DREXIT1":
-            self.state = State.EXIT1_DR
-        elif tokens[0] == "DRPAUSE":
-            self.state = State.PAUSE_DR
-        elif tokens[0] == "DREXIT2":
-            self.state = State.EXIT2_DR
-        elif tokens[0] == "DRUPDATE":
-            self.state = State.UPDATE_DR
-        elif tokens[0] == "IRSELECT":
-            self.state = State.SELECT_IR_SCAN
-        elif tokens[0] == "IRCAPTURE":
-            self.state = State.CAPTURE_IR
-        elif tokens[0] == "IRSHIFT":
-            self.state = State.SHIFT_IR
-        elif tokens[0] == "IREXIT1":
-            self.state = State.EXIT1_IR
-        elif tokens[0] == "IRPAUSE":
-            self.state = State.PAUSE_IR
-        elif tokens[0] == "IREXIT2":
-            self.state = State.EXIT2_IR
-        elif tokens[0] == "IRUPDATE":
-            self.state = State.UPDATE_IR
-        else:
-            assert False
+        self.state = self.STATES[tokens[0].upper()]
 
 class StateInstruction(Instruction):
+    __slots__ = ("states",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
-        self.states = [token.state for token in tokens]
+        self.states = tuple(token.state for token in tokens)
 
     def __str__(self):
         return f"STATE {', '.join(str(s) for s in self.states)}"
 
 class WaitType:
+    __slots__ = ("usec", "cycles")
     def __init__(self,  s, loc, tokens):
         self.usec = self.cycles = Int(0)
         if len(tokens) == 2 and tokens[1].upper() == "USEC":
@@ -345,6 +433,7 @@ class WaitType:
         return f"{self.cycles} CYCLES {self.usec} USEC"
 
 class TRSTInstruction(Instruction):
+    __slots__ = ("wait_cycles", "wait_usec")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         if len(tokens) == 0:
@@ -359,6 +448,7 @@ class TRSTInstruction(Instruction):
         return f"TRST {self.wait_cycles} CYCLES {self.wait_usec} USEC"
 
 class WaitInstruction(Instruction):
+    __slots__ = ("wait_state", "end_state", "wait_usec", "wait_cycles")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
 
@@ -396,6 +486,7 @@ class WaitInstruction(Instruction):
         return r
 
 class ForInstruction(Instruction):
+    __slots__ = ("var", "start", "end", "step")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 3 or len(tokens) == 4
@@ -408,6 +499,7 @@ class ForInstruction(Instruction):
         return f"FOR {self.var} = {self.start}..{self.end} STEP {self.step}"
 
 class NextInstruction(Instruction):
+    __slots__ = ("var",)
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 1
@@ -417,6 +509,7 @@ class NextInstruction(Instruction):
         return f"NEXT {self.var}"
 
 class ScanModifierInstruction(Instruction):
+    __slots__ = ("bits", "value")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         if len(tokens) == 1:
@@ -429,23 +522,24 @@ class ScanModifierInstruction(Instruction):
             assert False
 
 class PostDrInstruction(ScanModifierInstruction):
-    pass
+    __slots__ = ()
 
 class PostIrInstruction(ScanModifierInstruction):
-    pass
+    __slots__ = ()
 
 class PreDrInstruction(ScanModifierInstruction):
-    pass
+    __slots__ = ()
 
 class PreIrInstruction(ScanModifierInstruction):
-    pass
+    __slots__ = ()
 
 class ProcedureInstruction(Instruction):
+    __slots__ = ("name", "uses")
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
         assert len(tokens) == 2
         self.name = tokens[0]
-        self.uses = tokens[1]
+        self.uses = list(tokens[1])
 
     def __repr__(self):
         return f"<Procedure {self.name}>"
@@ -454,6 +548,7 @@ class ProcedureInstruction(Instruction):
         return f"PROCEDURE {self.name}"
 
 class EndProcedureInstruction(Instruction):
+    __slots__ = ()
     def __init__(self,  s, loc, tokens):
         Instruction.__init__(self, s, loc, tokens)
 
@@ -461,6 +556,7 @@ class EndProcedureInstruction(Instruction):
         return f"ENDPROC"
 
 class DataInstruction(Instruction):
+    __slots__ = ("name",)
     def __init__(self, s, loc, tokens):
         assert len(tokens) == 1
         Instruction.__init__(self, s, loc, tokens)
@@ -470,26 +566,42 @@ class DataInstruction(Instruction):
         return f"DATA {self.name}"
 
 class EndDataInstruction(Instruction):
+    __slots__ = ()
     def __str__(self):
         return f"<ENDDATA>"
 
+# bit reversal of every byte value
+_BITREV = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
 class Crc:
+    __slots__ = ("expected", "actual")
+    # skip CRC checking (for trusted files), set with EBYST_STAPL_SKIP_CRC=1
+    SKIP = os.environ.get("EBYST_STAPL_SKIP_CRC", "0") not in ("", "0")
+
     def __init__(self,  s, loc, tokens):
         assert len(tokens) == 1
         self.expected = int(tokens[0], 16)
 
-        if self.expected != 0:
-            CCITT_CRC =  0x8408
-            crc_register = 0xFFFF
-            for in_byte in s[:loc]:
-                in_byte = ord(in_byte)
-                if in_byte != 13:
-                    for _ in range(8):
-                        feedback = (in_byte ^ crc_register) & 0x01;
-                        crc_register >>= 1; # shift the shift register
-                        if feedback: crc_register ^= CCITT_CRC; # invert selected bits
-                        in_byte >>= 1; # get the next bit of in_byte
-
+        if self.SKIP:
+            logger.info("Skipping CRC check")
+            self.actual = self.expected
+        elif self.expected != 0:
+            # STAPL uses the reflected CCITT CRC, binascii.crc_hqx implements the non-reflected one; feeding it
+            # bit-reversed bytes (with carriage returns removed) and reversing the result gives the same checksum
+            if s.isascii():
+                # encode once, character and byte offsets are the same apart from the removed carriage returns
+                data = memoryview(s.encode().translate(_BITREV, b"\r"))[:loc - s.count("\r", 0, loc)]
+            else:
+                # the CRC covers the low byte of every character (not its UTF-8 encoding), carriage returns are removed
+                # before masking, so other characters ending in 0x0d are kept
+                text = s[:loc].replace("\r", "")
+                try:
+                    data = text.encode("latin-1")
+                except UnicodeEncodeError:
+                    data = bytes(ord(c) & 0xFF for c in text)
+                data = data.translate(_BITREV)
+            crc_register = binascii.crc_hqx(data, 0xFFFF)
+            crc_register = int(f"{crc_register:016b}"[::-1], 2)
             self.actual = (~crc_register) & 0xFFFF
         else:
             self.actual = 0
@@ -506,8 +618,14 @@ class Crc:
     def __str__(self):
         return f"CRC {self.expected:04x}"
 
-class StaplFile:
+class StaplFile(PickleCache):
     """STAPL parser"""
+    CACHE_SUFFIX = "stapl"
+    # packrat cache size, 0 disables packrat parsing; the grammar hardly backtracks, so memoizing costs more than it saves
+    # and it is disabled by default. Can be overridden with EBYST_STAPL_PACKRAT_CACHE ("none" for unbounded),
+    # EBYST_STAPL_NO_PACKRAT=1 always disables it
+    PACKRAT_CACHE_SIZE = 0
+    _grammar = None
 
     def __init__(self,  tokens):
         self.actions = {}
@@ -515,16 +633,18 @@ class StaplFile:
         self.data_blocks = {}
         self.labels = {}
         self.notes = []
+        self.crc = None
+        # instructions of all procedures and data blocks, labels are only kept in self.labels
         self.statements = []
         procedure = data_block = None
         for token in tokens:
             if isinstance(token, Note):
                 assert data_block is None and procedure is None
-                logger.info(f"NOTE: {token}")
+                logger.info("NOTE: %s", token)
                 self.notes.append(token)
             elif isinstance(token, Action):
                 assert data_block is None and procedure is None
-                logger.debug(f"Action: {token.name}")
+                logger.debug("Action: %s", token.name)
                 self.actions[token.name] = token
             elif isinstance(token, LabelledInstruction):
                 if isinstance(token.instruction, ProcedureInstruction):
@@ -543,118 +663,154 @@ class StaplFile:
                 if not token.label is None:
                     assert not procedure is None
                     self.labels[procedure][token.label] = len(self.statements)
-                self.statements.append(token)
+                self.statements.append(token.instruction)
             elif isinstance(token, Crc):
-                if not token.is_correct():
-                    logger.warning(f"CRC check failed ({token.actual:04x}, expected: {token.expected:04x})")
+                self.crc = token
             else:
                 assert False
+        self.statements = tuple(self.statements)
+
+        # resolve CALL and GOTO targets; unresolved targets are reported when executed
+        procedure = None
+        for instruction in self.statements:
+            if isinstance(instruction, ProcedureInstruction):
+                procedure = instruction.name
+            elif isinstance(instruction, EndProcedureInstruction):
+                procedure = None
+            while isinstance(instruction, IfInstruction):
+                instruction = instruction.instruction
+            if isinstance(instruction, CallInstruction):
+                instruction.pc = self.procedures.get(instruction.procedure)
+            elif isinstance(instruction, GotoInstruction) and not procedure is None:
+                instruction.pc = self.labels[procedure].get(instruction.label)
+
+        self.check_crc()
+
+    def check_crc(self):
+        """Log a warning when the file's CRC did not match, returns whether it did"""
+        if self.crc is None or self.crc.is_correct():
+            return True
+        logger.warning("CRC check failed (%04x, expected: %04x)", self.crc.actual, self.crc.expected)
+        return False
 
     @classmethod
-    def parse(cls, f):
-        comments = "`" + pp.SkipTo(pp.LineEnd())
+    def _build_grammar(cls):
+        comments = pp.Regex(r"`[^\n]*")
         instruction = pp.Forward()
 
         expression = Expression.get_parse_rule()
-        identifier = pp.Word(init_chars=pp.srange("[a-zA-Z]"), body_chars=pp.srange("[a-zA-Z0-9_]"))
-        variable_decl = (identifier + pp.Opt(pp.Literal("[").suppress() - expression - pp.Literal("]").suppress())).set_parse_action(VariableDecl)
-        state_name = pp.MatchFirst((pp.CaselessKeyword("RESET"),
-                                    pp.CaselessKeyword("IDLE"),
-                                    pp.CaselessKeyword("DRSELECT"),
-                                    pp.CaselessKeyword("DRCAPTURE"),
-                                    pp.CaselessKeyword("DRSHIFT"),
-                                    pp.CaselessKeyword("DREXIT1"),
-                                    pp.CaselessKeyword("DRPAUSE"),
-                                    pp.CaselessKeyword("DREXIT2"),
-                                    pp.CaselessKeyword("DRUPDATE"),
-                                    pp.CaselessKeyword("IRSELECT"),
-                                    pp.CaselessKeyword("IRCAPTURE"),
-                                    pp.CaselessKeyword("IRSHIFT"),
-                                    pp.CaselessKeyword("IREXIT1"),
-                                    pp.CaselessKeyword("IRPAUSE"),
-                                    pp.CaselessKeyword("IREXIT2"),
-                                    pp.CaselessKeyword("IRUPDATE"))).set_parse_action(StateConvert)
-
-        str_expression = pp.Or((pp.QuotedString("\""), expression)) # TODO
+        identifier = pp.Regex(r"[a-zA-Z][a-zA-Z0-9_]*").set_parse_action(lambda tokens: sys.intern(tokens[0]))
+        variable_decl = (identifier + pp.Opt(LBRACK - expression - RBRACK)).set_parse_action(VariableDecl)
+        # a single regex instead of trying 16 keywords in turn
+        state_name = pp.Regex(r"(?i)(?:" + "|".join(StateConvert.STATES) + r")(?![a-zA-Z0-9_$])").set_name(
+                              "state name").set_parse_action(StateConvert)
 
+        str_expression = pp.MatchFirst((pp.QuotedString("\""), expression)) # TODO
+
+        action_opt = pp.MatchFirst((pp.CaselessKeyword("OPTIONAL") - pp.Tag("opt", "optional"),
+                                    pp.CaselessKeyword("RECOMMENDED") - pp.Tag("opt", "recommended"),
+                                    pp.Tag("opt", "required")))
         action = (pp.CaselessKeyword("ACTION").suppress() - identifier - pp.Group(pp.Opt(pp.QuotedString("\""))) -
-                  pp.Literal("=").suppress() -
-                  pp.Group(identifier - pp.Or((pp.CaselessKeyword("OPTIONAL") - pp.Tag("opt", "optional"),
-                                               pp.CaselessKeyword("RECOMMENDED") - pp.Tag("opt", "recommended"),
-                                               pp.Tag("opt", "required")))) -
-                  pp.ZeroOrMore(pp.Literal(",").suppress() - pp.Group(identifier -
-                                pp.Or((pp.CaselessKeyword("OPTIONAL") - pp.Tag("opt", "optional"),
-                                       pp.CaselessKeyword("RECOMMENDED") - pp.Tag("opt", "recommended"),
-                                       pp.Tag("opt", "required"))))) -
-                  pp.Literal(";").suppress()).set_parse_action(Action)
-        variable = (pp.Word(init_chars=pp.srange("[a-zA-Z]"), body_chars=pp.srange("[a-zA-Z0-9_]")) -
-                    pp.Opt(pp.Literal("[").suppress() - pp.Opt(expression - pp.Opt(pp.Literal("..").suppress() - expression)) -
-                           pp.Literal("]").suppress())).set_parse_action(Variable)
-        assignment = (variable + pp.Literal("=").suppress() - expression - pp.Suppress(pp.Literal(";"))).set_parse_action(AssignmentInstruction)
-        boolean = (pp.CaselessKeyword("BOOLEAN").suppress() - variable_decl - pp.Opt(pp.Literal("=").suppress() -
-                           expression) - pp.Literal(";").suppress()).set_parse_action(BooleanInstruction)
-        call = (pp.CaselessKeyword("CALL").suppress() - identifier - pp.Suppress(pp.Literal(";"))).set_parse_action(CallInstruction)
-        crc = (pp.CaselessKeyword("CRC").suppress() - pp.Word(pp.srange("[0-9a-fA-F]")) - pp.Literal(";").suppress()).set_parse_action(Crc)
-        data = (pp.CaselessKeyword("DATA").suppress() - identifier - pp.Suppress(pp.Literal(";"))).set_parse_action(DataInstruction)
-        drscan = (pp.CaselessKeyword("DRSCAN").suppress() - expression - pp.Literal(",").suppress() - expression -
-                          pp.Opt(pp.Literal(",").suppress() + pp.CaselessKeyword("CAPTURE") - variable) -
-                          pp.Opt(pp.Literal(",").suppress() - pp.CaselessKeyword("COMPARE") - expression -
-                                 pp.Literal(",").suppress() - expression + pp.Literal(",").suppress() - variable) -
-                          pp.Literal(";").suppress()).set_parse_action(DrScanInstruction)
-        drstop = (pp.CaselessKeyword("DRSTOP").suppress() - state_name - pp.Suppress(pp.Literal(";"))).set_parse_action(DrStopInstruction)
-        end_data = (pp.CaselessKeyword("ENDDATA").suppress() - pp.Literal(";").suppress()).set_parse_action(EndDataInstruction)
-        end_procedure = (pp.CaselessKeyword("ENDPROC").suppress() - pp.Literal(";").suppress()).set_parse_action(EndProcedureInstruction)
-        exit = (pp.CaselessKeyword("EXIT").suppress() - expression - pp.Suppress(pp.Literal(";"))).set_parse_action(ExitInstruction)
+                  EQ -
+                  pp.Group(identifier - action_opt) -
+                  pp.ZeroOrMore(COMMA - pp.Group(identifier - action_opt)) -
+                  SEMI).set_parse_action(Action)
+        variable = (identifier -
+                    pp.Opt(LBRACK - pp.Opt(expression - pp.Opt(DOTDOT - expression)) - RBRACK)).set_parse_action(Variable)
+        assignment = (variable + EQ - expression - SEMI).set_parse_action(AssignmentInstruction)
+        boolean = (pp.CaselessKeyword("BOOLEAN").suppress() - variable_decl - pp.Opt(EQ -
+                           expression) - SEMI).set_parse_action(BooleanInstruction)
+        call = (pp.CaselessKeyword("CALL").suppress() - identifier - SEMI).set_parse_action(CallInstruction)
+        crc = (pp.CaselessKeyword("CRC").suppress() - pp.Regex(r"[0-9a-fA-F]+") - SEMI).set_parse_action(Crc)
+        data = (pp.CaselessKeyword("DATA").suppress() - identifier - SEMI).set_parse_action(DataInstruction)
+        scan_args = (expression - COMMA - expression - pp.Opt(COMMA + KW_CAPTURE - variable) -
+                     pp.Opt(COMMA - KW_COMPARE - expression - COMMA - expression + COMMA - variable) - SEMI)
+        drscan = (pp.CaselessKeyword("DRSCAN").suppress() - scan_args).set_parse_action(DrScanInstruction)
+        drstop = (pp.CaselessKeyword("DRSTOP").suppress() - state_name - SEMI).set_parse_action(DrStopInstruction)
+        end_data = (pp.CaselessKeyword("ENDDATA").suppress() - SEMI).set_parse_action(EndDataInstruction)
+        end_procedure = (pp.CaselessKeyword("ENDPROC").suppress() - SEMI).set_parse_action(EndProcedureInstruction)
+        exit = (pp.CaselessKeyword("EXIT").suppress() - expression - SEMI).set_parse_action(ExitInstruction)
         export = (pp.CaselessKeyword("EXPORT").suppress() - str_expression -
-                  pp.ZeroOrMore(pp.Suppress(pp.Literal(",")) - str_expression) - pp.Literal(";").suppress()).set_parse_action(ExportInstruction)
-        for_ = (pp.CaselessKeyword("FOR").suppress() - identifier - pp.Literal("=").suppress() - expression -
+                  pp.ZeroOrMore(COMMA - str_expression) - SEMI).set_parse_action(ExportInstruction)
+        for_ = (pp.CaselessKeyword("FOR").suppress() - identifier - EQ - expression -
                 pp.CaselessKeyword("TO").suppress() - expression -
-                pp.Opt(pp.CaselessKeyword("STEP").suppress() - expression) - pp.Suppress(pp.Literal(";"))).set_parse_action(ForInstruction)
-        frequency = (pp.CaselessKeyword("FREQUENCY").suppress() - pp.Opt(expression) - pp.Literal(";").suppress()).set_parse_action(FrequencyInstruction)
-        goto = (pp.CaselessKeyword("GOTO") - identifier - pp.Suppress(pp.Literal(";"))).set_parse_action(GotoInstruction)
+                pp.Opt(pp.CaselessKeyword("STEP").suppress() - expression) - SEMI).set_parse_action(ForInstruction)
+        frequency = (pp.CaselessKeyword("FREQUENCY").suppress() - pp.Opt(expression) - SEMI).set_parse_action(FrequencyInstruction)
+        goto = (pp.CaselessKeyword("GOTO") - identifier - SEMI).set_parse_action(GotoInstruction)
         if_ = (pp.CaselessKeyword("IF").suppress() - expression - pp.CaselessKeyword("THEN").suppress() - instruction).set_parse_action(IfInstruction)
         integer = (pp.CaselessKeyword("INTEGER").suppress() - variable_decl -
-                           pp.Opt(pp.Literal("=").suppress() - expression - pp.ZeroOrMore(pp.Literal(",").suppress() - expression)) - pp.Literal(";").suppress()).set_parse_action(IntegerInstruction)
-        irscan = (pp.CaselessKeyword("IRSCAN").suppress() - expression - pp.Literal(",").suppress() - expression -
-                          pp.Opt(pp.Literal(",").suppress() + pp.CaselessKeyword("CAPTURE") - variable) -
-                          pp.Opt(pp.Literal(",").suppress() - pp.CaselessKeyword("COMPARE") - expression -
-                                 pp.Literal(",").suppress() - expression + pp.Literal(",").suppress() - variable) -
-                          pp.Literal(";").suppress()).set_parse_action(IrScanInstruction)
-        irstop = (pp.CaselessKeyword("IRSTOP").suppress() - state_name - pp.Suppress(pp.Literal(";"))).set_parse_action(IrStopInstruction)
-        next =  (pp.CaselessKeyword("NEXT").suppress() - identifier - pp.Literal(";").suppress()).set_parse_action(NextInstruction)
-        note = (pp.CaselessKeyword("NOTE").suppress() - pp.QuotedString("\"") - pp.QuotedString("\"") - pp.Literal(";").suppress()).set_parse_action(Note)
-        pop = ((pp.CaselessKeyword("POP").suppress() - variable - pp.Suppress(pp.Literal(";")))).set_parse_action(PopInstruction)
-        postdr = ((pp.CaselessKeyword("POSTDR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - pp.Literal(";").suppress())).set_parse_action(PostDrInstruction)
-        postir = ((pp.CaselessKeyword("POSTIR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - pp.Literal(";").suppress())).set_parse_action(PostIrInstruction)
-        predr = ((pp.CaselessKeyword("PREDR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - pp.Literal(";").suppress())).set_parse_action(PreDrInstruction)
-        preir = ((pp.CaselessKeyword("PREIR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - pp.Literal(";").suppress())).set_parse_action(PreIrInstruction)
+                           pp.Opt(EQ - expression - pp.ZeroOrMore(COMMA - expression)) - SEMI).set_parse_action(IntegerInstruction)
+        irscan = (pp.CaselessKeyword("IRSCAN").suppress() - scan_args).set_parse_action(IrScanInstruction)
+        irstop = (pp.CaselessKeyword("IRSTOP").suppress() - state_name - SEMI).set_parse_action(IrStopInstruction)
+        next =  (pp.CaselessKeyword("NEXT").suppress() - identifier - SEMI).set_parse_action(NextInstruction)
+        note = (pp.CaselessKeyword("NOTE").suppress() - pp.QuotedString("\"") - pp.QuotedString("\"") - SEMI).set_parse_action(Note)
+        pop = ((pp.CaselessKeyword("POP").suppress() - variable - SEMI)).set_parse_action(PopInstruction)
+        postdr = ((pp.CaselessKeyword("POSTDR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - SEMI)).set_parse_action(PostDrInstruction)
+        postir = ((pp.CaselessKeyword("POSTIR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - SEMI)).set_parse_action(PostIrInstruction)
+        predr = ((pp.CaselessKeyword("PREDR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - SEMI)).set_parse_action(PreDrInstruction)
+        preir = ((pp.CaselessKeyword("PREIR").suppress() - expression - pp.Opt(pp.Literal(",") - expression) - SEMI)).set_parse_action(PreIrInstruction)
         print_ = (pp.CaselessKeyword("PRINT").suppress() - str_expression -
-                  pp.ZeroOrMore(pp.Suppress(pp.Literal(",")) - str_expression) - pp.Literal(";").suppress()).set_parse_action(PrintInstruction)
+                  pp.ZeroOrMore(COMMA - str_expression) - SEMI).set_parse_action(PrintInstruction)
         procedure = (pp.CaselessKeyword("PROCEDURE").suppress() - identifier -
-                     pp.Group(pp.Opt(pp.CaselessKeyword("USES").suppress() - identifier - pp.ZeroOrMore(pp.Literal(",").suppress() - identifier))) -
-                     pp.Literal(";").suppress()).set_parse_action(ProcedureInstruction)
-        push = (pp.CaselessKeyword("PUSH").suppress() - expression - pp.Suppress(pp.Literal(";"))).set_parse_action(PushInstruction)
-        state = (pp.CaselessKeyword("STATE").suppress() - pp.OneOrMore(state_name) - pp.Literal(";").suppress()).set_parse_action(StateInstruction)
-        wait_type = pp.Or((expression - pp.CaselessKeyword("CYCLES") -
-                           pp.Opt(pp.Suppress(pp.Literal(",")) + expression + pp.CaselessKeyword("USEC")),
-                           expression - pp.CaselessKeyword("USEC"))).set_parse_action(WaitType)
-        trst = (pp.CaselessKeyword("TRST").suppress() - pp.Opt(wait_type) - pp.Suppress(pp.Literal(";"))).set_parse_action(TRSTInstruction)
-        wait = (pp.CaselessKeyword("WAIT").suppress() - pp.Opt(state_name - pp.Suppress(pp.Literal(","))) -
-                        wait_type - pp.Opt(pp.Suppress(pp.Literal(",")) - state_name) -
-                        pp.Opt(pp.CaselessKeyword("MAX").suppress() - wait_type) - pp.Suppress(pp.Literal(";"))).set_parse_action(WaitInstruction)
-
-        opt_label = pp.Group(pp.Opt(identifier + pp.Suppress(pp.Literal(":"))))
-        instruction <<= pp.MatchFirst((assignment, boolean, call, data, drscan, drstop, end_data, end_procedure, exit,
-                                       export, for_, frequency, goto, if_, integer, irscan, irstop, next, note, pop,
-                                       print_, procedure, push, state, trst, wait))
+                     pp.Group(pp.Opt(pp.CaselessKeyword("USES").suppress() - identifier - pp.ZeroOrMore(COMMA - identifier))) -
+                     SEMI).set_parse_action(ProcedureInstruction)
+        push = (pp.CaselessKeyword("PUSH").suppress() - expression - SEMI).set_parse_action(PushInstruction)
+        state = (pp.CaselessKeyword("STATE").suppress() - pp.OneOrMore(state_name) - SEMI).set_parse_action(StateInstruction)
+        wait_type = (expression - pp.MatchFirst((KW_CYCLES - pp.Opt(COMMA + expression + KW_USEC),
+                                                 KW_USEC))).set_parse_action(WaitType)
+        trst = (pp.CaselessKeyword("TRST").suppress() - pp.Opt(wait_type) - SEMI).set_parse_action(TRSTInstruction)
+        wait = (pp.CaselessKeyword("WAIT").suppress() - pp.Opt(state_name - COMMA) -
+                        wait_type - pp.Opt(COMMA - state_name) -
+                        pp.Opt(pp.CaselessKeyword("MAX").suppress() - wait_type) - SEMI).set_parse_action(WaitInstruction)
+
+        opt_label = pp.Group(pp.Opt(identifier + COLON))
+        instruction <<= _KeywordSwitch({"BOOLEAN": boolean, "CALL": call, "DATA": data, "DRSCAN": drscan,
+                                        "DRSTOP": drstop, "ENDDATA": end_data, "ENDPROC": end_procedure, "EXIT": exit,
+                                        "EXPORT": export, "FOR": for_, "FREQUENCY": frequency, "GOTO": goto, "IF": if_,
+                                        "INTEGER": integer, "IRSCAN": irscan, "IRSTOP": irstop, "NEXT": next,
+                                        "NOTE": note, "POP": pop, "PRINT": print_, "PROCEDURE": procedure,
+                                        "PUSH": push, "STATE": state, "TRST": trst, "WAIT": wait}, assignment)
         statement = (opt_label + instruction).set_parse_action(LabelledInstruction)
 
         stapl_file = (pp.ZeroOrMore(note) - pp.ZeroOrMore(action) - pp.ZeroOrMore(statement) - crc - pp.StringEnd())
 
         stapl_file.ignore(comments)
-        stapl_file.enable_packrat()
+        # streamline once here, the grammar is reused for every parse
+        stapl_file.streamline()
+        return stapl_file
 
-        logger.debug(f"Parsing stapl...")
-        f = StaplFile(stapl_file.parse_string(f.read()))
-        logger.debug(f"Stapl loaded")
+    @classmethod
+    def parse(cls, f):
+        if cls._grammar is None:
+            cls._grammar = cls._build_grammar()
+        # packrat parsing is a process-wide setting, only switch it on for the duration of this parse; pyparsing has no
+        # public query for it, enable_packrat() swaps in the memoizing _parse
+        enabled_packrat = False
+        if (os.environ.get("EBYST_STAPL_NO_PACKRAT", "0") in ("", "0") and
+                not pp.ParserElement._parse is pp.ParserElement._parseCache):
+            size = os.environ.get("EBYST_STAPL_PACKRAT_CACHE") or str(cls.PACKRAT_CACHE_SIZE)
+            if size.lower() == "none":
+                pp.ParserElement.enable_packrat(None)
+                enabled_packrat = True
+            elif int(size) > 0:
+                pp.ParserElement.enable_packrat(int(size))
+                enabled_packrat = True
+
+        logger.debug("Parsing stapl...")
+        try:
+            f = StaplFile(cls._grammar.parse_string(f.read()))
+        finally:
+            if enabled_packrat:
+                pp.ParserElement.disable_memoization()
+            else:
+                # the packrat cache holds on to the input text and intermediate results until the next parse
+                pp.ParserElement.reset_cache()
+        logger.debug("Stapl loaded")
         return f
+
+    @classmethod
+    def load(cls, path):
+        stapl = super().load(path)
+        # the file isn't parsed again, so report a bad CRC on every load
+        stapl.check_crc()
+        return stapl
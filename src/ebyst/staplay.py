@@ -78,13 +78,13 @@ def main():
 
     logger.info("Parsing stapl...")
     with open(args.stapl_file, "r") as f:
-        stapl = StaplFile.parse(f)
+        stapl = StaplFile.load_cached(f)
     logger.info("Done")
 
     logger.info("Start running")
     interpreter = StaplInterpreter(ctl, stapl)
     for action in args.action:
-        logger.info(f"Running action {action}")
+        logger.info("Running action %s", action)
         interpreter.run(action, optional=args.optional)
 
 if __name__ == "__main__":
@@ -22,7 +22,8 @@ import logging
 import asyncio
 import time
 
-from bitarray import bitarray
+from bitarray import bitarray, frozenbitarray
+from bitarray.util import zeros, ones
 
 from .drivers.driver import Driver
 from .device import Device
@@ -58,27 +59,159 @@ class Opcode(Enum):
     EXTEST = "EXTEST"
     EXTEST_PULSE = "EXTEST_PULSE"
 
+def _tms_path(state: State, target_state: State) -> frozenbitarray:
+    """TMS sequence to go from state to target_state"""
+    tms = bitarray(endian='little')
+    while state != target_state:
+        if state == State.TEST_LOGIC_RESET:
+            tms.append(0)
+            state = State.RUN_TEST_IDLE
+        elif state == State.RUN_TEST_IDLE:
+            tms.append(1)
+            state = State.SELECT_DR_SCAN
+        elif state == State.SELECT_DR_SCAN:
+            if target_state > State.SELECT_DR_SCAN and target_state <= State.UPDATE_DR:
+                tms.append(0)
+                state = State.CAPTURE_DR
+            else:
+                tms.append(1)
+                state = State.SELECT_IR_SCAN
+        elif state == State.CAPTURE_DR:
+            if target_state == State.SHIFT_DR:
+                tms.append(0)
+                state = State.SHIFT_DR
+            else:
+                tms.append(1)
+                state = State.EXIT1_DR
+        elif state == State.SHIFT_DR:
+            tms.append(1)
+            state = State.EXIT1_DR
+        elif state == State.EXIT1_DR:
+            if target_state in (State.PAUSE_DR, State.EXIT2_DR, State.SHIFT_DR):
+                tms.append(0)
+                state = State.PAUSE_DR
+            else:
+                tms.append(1)
+                state = State.UPDATE_DR
+        elif state == State.PAUSE_DR:
+            tms.append(1)
+            state = State.EXIT2_DR
+        elif state == State.EXIT2_DR:
+            if target_state in (State.SHIFT_DR, State.EXIT1_DR, State.PAUSE_DR):
+                tms.append(0)
+                state = State.SHIFT_DR
+            else:
+                tms.append(1)
+                state = State.UPDATE_DR
+        elif state == State.UPDATE_DR:
+            if target_state == State.RUN_TEST_IDLE:
+                tms.append(0)
+                state = State.RUN_TEST_IDLE
+            else:
+                tms.append(1)
+                state = State.SELECT_DR_SCAN
+        elif state == State.SELECT_IR_SCAN:
+            if target_state > State.SELECT_IR_SCAN and target_state <= State.UPDATE_IR:
+                tms.append(0)
+                state = State.CAPTURE_IR
+            else:
+                tms.append(1)
+                state = State.TEST_LOGIC_RESET
+        elif state == State.CAPTURE_IR:
+            if target_state == State.SHIFT_IR:
+                tms.append(0)
+                state = State.SHIFT_IR
+            else:
+                tms.append(1)
+                state = State.EXIT1_IR
+        elif state == State.SHIFT_IR:
+            tms.append(1)
+            state = State.EXIT1_IR
+        elif state == State.EXIT1_IR:
+            if target_state in (State.PAUSE_IR, State.EXIT2_IR, State.SHIFT_IR):
+                tms.append(0)
+                state = State.PAUSE_IR
+            else:
+                tms.append(1)
+                state = State.UPDATE_IR
+        elif state == State.PAUSE_IR:
+            tms.append(1)
+            state = State.EXIT2_IR
+        elif state == State.EXIT2_IR:
+            if target_state in (State.SHIFT_IR, State.EXIT1_IR, State.PAUSE_IR):
+                tms.append(0)
+                state = State.SHIFT_IR
+            else:
+                tms.append(1)
+                state = State.UPDATE_IR
+        elif state == State.UPDATE_IR:
+            if target_state == State.RUN_TEST_IDLE:
+                tms.append(0)
+                state = State.RUN_TEST_IDLE
+            else:
+                tms.append(1)
+                state = State.SELECT_DR_SCAN
+        else:
+            assert False
+
+    return frozenbitarray(tms)
+
+# TMS sequences for all state transitions, computed once instead of walking the state machine on every transition
+TMS_PATHS = {(state, target_state): _tms_path(state, target_state) for state in State for target_state in State}
+
+# constant bit strings, built once instead of on every use; wait() slices short runs from _ZEROS/_ONES
+_ZEROS = frozenbitarray(zeros(MAX_IR_CHAIN_LENGTH, 'little'))
+_ONES = ~_ZEROS
+# chain detection: load the chain with 0's, then shift 1's until they appear on TDO
+_CHAIN_PROBE = _ZEROS + frozenbitarray('0', 'little') + _ONES
+
 class TapController:
     class Chain(list):
         """Chain of devices, 0 is close to TDI"""
         def __init__(self, *args, **kwargs):
             list.__init__(self, *args, **kwargs)
             self.validated = False
+            self._devices = ()
+            self._ir_cache = {}
+            self._brlen = None
+
+        def _check_devices(self):
+            # drop the cached strings and lengths when the devices changed; compared by identity, and the snapshot keeps
+            # the old devices alive, so it works for all list mutators without overriding each of them
+            devices = tuple(self)
+            if devices != self._devices:
+                self._devices = devices
+                self._ir_cache.clear()
+                self._brlen = None
 
         @property
         def brlen(self):
-            r = 0
-            for dev in self:
-                r += len(dev.cells)
-            return r
+            # needed on every boundary register cycle, only changes when the devices change
+            self._check_devices()
+            if self._brlen is None:
+                self._brlen = sum(len(dev.cells) for dev in self)
+            return self._brlen
 
         def generate_ir(self, instruction):
-            tdi_str = bitarray(endian='little')
-            for dev in self:
-                try:
-                    tdi_str = dev.opcodes[instruction.value] + tdi_str
-                except KeyError:
-                    raise Exception(f"Instruction {instruction} not supported by all devices in chain")
+            # the instruction register string only depends on the devices in the chain, build it once per instruction
+            self._check_devices()
+            tdi_str = self._ir_cache.get(instruction)
+            if tdi_str is None:
+                tdi_str = self._ir_cache[instruction] = frozenbitarray(self._generate_ir(instruction))
+            return tdi_str
+
+        def _generate_ir(self, instruction):
+            try:
+                opcodes = [dev.opcodes[instruction.value] for dev in self]
+            except KeyError:
+                raise Exception(f"Instruction {instruction} not supported by all devices in chain")
+            # device 0 ends up at the end of the string; fill a preallocated string from the back, instead of
+            # prepending (and copying) for every device
+            pos = sum(len(opcode) for opcode in opcodes)
+            tdi_str = bitarray(pos, endian='little')
+            for opcode in opcodes:
+                tdi_str[pos-len(opcode):pos] = opcode
+                pos -= len(opcode)
             return tdi_str
 
         def reset(self):
@@ -86,9 +219,12 @@ class TapController:
                 dev.reset()
 
         def generate_br(self):
-            tdi_str = bitarray(endian='little')
+            pos = self.brlen
+            tdi_str = bitarray(pos, endian='little')
             for dev in self:
-                tdi_str = dev.generate_br() + tdi_str
+                br = dev.generate_br()
+                tdi_str[pos-len(br):pos] = br
+                pos -= len(br)
             return tdi_str
 
         def update_br(self, br):
@@ -117,67 +253,66 @@ class TapController:
     def load_instruction(self, instruction: Opcode):
         if not self.chain.validated: raise Exception("Chain not validated")
         tdi_str = self.chain.generate_ir(instruction)
-        logger.debug(f"Loading instruction {instruction}")
-        self._goto(State.SHIFT_IR)
-        self.driver.transmit_tdi_str(tdi_str, first_tms=0 if len(tdi_str) > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_IR
-        self._goto(State.UPDATE_IR)
+        logger.debug("Loading instruction %s", instruction)
+        with self.driver.batch():
+            self._goto(State.SHIFT_IR)
+            self.driver.transmit_tdi_str(tdi_str, first_tms=0 if len(tdi_str) > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_IR
+            self._goto(State.UPDATE_IR)
         self.in_extest = False
 
     def read_register(self, n: int):
         if not self.chain.validated: raise Exception("Chain not validated")
-        self._goto(State.SHIFT_DR)
-        tdo = self.driver.receive_tdo_str(n, first_tms=0 if n > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_DR
-        self._goto(State.UPDATE_DR)
+        with self.driver.batch():
+            self._goto(State.SHIFT_DR)
+            tdo = self.driver.receive_tdo_str(n, first_tms=0 if n > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_DR
+            self._goto(State.UPDATE_DR)
         return tdo
 
     def write_register(self, tdi: bitarray):
         if not self.chain.validated: raise Exception("Chain not validated")
-        self._goto(State.SHIFT_DR)
-        self.driver.transmit_tdi_str(tdi, first_tms=0 if len(tdi) > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_DR
-        self._goto(State.UPDATE_DR)
+        with self.driver.batch():
+            self._goto(State.SHIFT_DR)
+            self.driver.transmit_tdi_str(tdi, first_tms=0 if len(tdi) > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_DR
+            self._goto(State.UPDATE_DR)
 
     def read_write_register(self, tdi: bitarray):
         if not self.chain.validated: raise Exception("Chain not validated")
-        self._goto(State.SHIFT_DR)
-        tdo = self.driver.transfer_tdi_tdo_str(tdi, first_tms=0 if len(tdi) > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_DR
-        self._goto(State.UPDATE_DR)
+        with self.driver.batch():
+            self._goto(State.SHIFT_DR)
+            tdo = self.driver.transfer_tdi_tdo_str(tdi, first_tms=0 if len(tdi) > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_DR
+            self._goto(State.UPDATE_DR)
         return tdo
 
+    def _measure_shift_length(self):
+        """Measure the length of the currently selected shift register chain, by loading it with 0's and then
+           shifting in 1's until the first 1 appears on TDO"""
+        # all bits are shifted in one go, and the rising edge is located in the captured TDO string, instead of
+        # shifting (and reading back) one bit at a time
+        tdo = self.driver.transfer_tdi_tdo_str(_CHAIN_PROBE)
+        if tdo[MAX_IR_CHAIN_LENGTH] != 0:
+            raise Exception("Chain detection failed: TDO stuck at 1")
+        length = tdo.find(1, MAX_IR_CHAIN_LENGTH + 1)
+        if length < 0:
+            raise Exception("Chain detection failed: TDO stuck at 0")
+        return length - MAX_IR_CHAIN_LENGTH - 1
+
     def detect_chain(self):
         """Detect chain length (nr of devices and total instruction register length"""
         try:
             self._goto(State.SHIFT_IR)
-            # load IR with 0
-            self.driver.transmit_tdi_str(bitarray('0', endian='little') * MAX_IR_CHAIN_LENGTH)
-            if self.driver.transfer(0, 0) != 0:
-                raise Exception("Chain detection failed: TDO stuck at 1")
-            # load IR with 1, find rising edge position
-            irlen = 0
-            while self.driver.transfer(0, 1) == 0:
-                irlen += 1
-                if irlen >= MAX_IR_CHAIN_LENGTH:
-                    raise Exception("Chain detection failed: TDO stuck at 0")
+            irlen = self._measure_shift_length()
             # IR is now all 1's => BYPASS
             self._goto(State.UPDATE_IR, 1)
             self._goto(State.SHIFT_DR)
-            # load BYPASS with 0
-            self.driver.transmit_tdi_str(bitarray('0', endian='little') * MAX_IR_CHAIN_LENGTH)
-            if self.driver.transfer(0, 0) != 0:
-                raise Exception("Chain detection failed: TDO stuck at 1")
-            # load BYPASS with 1, find rising edge position
-            drlen = 0
-            while self.driver.transfer(0, 1) == 0:
-                drlen += 1
-                if drlen >= MAX_IR_CHAIN_LENGTH:
-                    raise Exception("Chain detection failed: TDO stuck at 0")
+            drlen = self._measure_shift_length()
         finally:
             self._goto(State.TEST_LOGIC_RESET)
 
-        logger.info(f"Found {drlen} device(s) with a total IR chain length of {irlen}")
+        logger.info("Found %d device(s) with a total IR chain length of %d", drlen, irlen)
         return (drlen, irlen)
 
     def add_device(self, device: Device):
@@ -262,105 +397,15 @@ class TapController:
 
     def _goto(self, target_state: State, tdi=0):
         state = self.state
-        if state == target_state: return
-        logger.debug(f"Going from {state.name} to {target_state.name}")
-        tms = bitarray(endian='little')
-        while state != target_state:
-            if state == State.TEST_LOGIC_RESET:
-                tms.append(0)
-                state = State.RUN_TEST_IDLE
-            elif state == State.RUN_TEST_IDLE:
-                tms.append(1)
-                state = State.SELECT_DR_SCAN
-            elif state == State.SELECT_DR_SCAN:
-                if target_state > State.SELECT_DR_SCAN and target_state <= State.UPDATE_DR:
-                    tms.append(0)
-                    state = State.CAPTURE_DR
-                else:
-                    tms.append(1)
-                    state = State.SELECT_IR_SCAN
-            elif state == State.CAPTURE_DR:
-                if target_state == State.SHIFT_DR:
-                    tms.append(0)
-                    state = State.SHIFT_DR
-                else:
-                    tms.append(1)
-                    state = State.EXIT1_DR
-            elif state == State.SHIFT_DR:
-                tms.append(1)
-                state = State.EXIT1_DR
-            elif state == State.EXIT1_DR:
-                if target_state in (State.PAUSE_DR, State.EXIT2_DR, State.SHIFT_DR):
-                    tms.append(0)
-                    state = State.PAUSE_DR
-                else:
-                    tms.append(1)
-                    state = State.UPDATE_DR
-            elif state == State.PAUSE_DR:
-                tms.append(1)
-                state = State.EXIT2_DR
-            elif state == State.EXIT2_DR:
-                if target_state in (State.SHIFT_DR, State.EXIT1_DR, State.PAUSE_DR):
-                    tms.append(0)
-                    state = State.SHIFT_DR
-                else:
-                    tms.append(1)
-                    state = State.UPDATE_DR
-            elif state == State.UPDATE_DR:
-                if target_state == State.RUN_TEST_IDLE:
-                    tms.append(0)
-                    state = State.RUN_TEST_IDLE
-                else:
-                    tms.append(1)
-                    state = State.SELECT_DR_SCAN
-            elif state == State.SELECT_IR_SCAN:
-                if target_state > State.SELECT_IR_SCAN and target_state <= State.UPDATE_IR:
-                    tms.append(0)
-                    state = State.CAPTURE_IR
-                else:
-                    tms.append(1)
-                    state = State.TEST_LOGIC_RESET
-            elif state == State.CAPTURE_IR:
-                if target_state == State.SHIFT_IR:
-                    tms.append(0)
-                    state = State.SHIFT_IR
-                else:
-                    tms.append(1)
-                    state = State.EXIT1_IR
-            elif state == State.SHIFT_IR:
-                tms.append(1)
-                state = State.EXIT1_IR
-            elif state == State.EXIT1_IR:
-                if target_state in (State.PAUSE_IR, State.EXIT2_IR, State.SHIFT_IR):
-                    tms.append(0)
-                    state = State.PAUSE_IR
-                else:
-                    tms.append(1)
-                    state = State.UPDATE_IR
-            elif state == State.PAUSE_IR:
-                tms.append(1)
-                state = State.EXIT2_IR
-            elif state == State.EXIT2_IR:
-                if target_state in (State.SHIFT_IR, State.EXIT1_IR, State.PAUSE_IR):
-                    tms.append(0)
-                    state = State.SHIFT_IR
-                else:
-                    tms.append(1)
-                    state = State.UPDATE_IR
-            elif state == State.UPDATE_IR:
-                if target_state == State.RUN_TEST_IDLE:
-                    tms.append(0)
-                    state = State.RUN_TEST_IDLE
-                else:
-                    tms.append(1)
-                    state = State.SELECT_DR_SCAN
-            else:
-                assert False
-
-        logger.debug(f"TMS string: {tms}")
+        if state is target_state: return
+        tms = TMS_PATHS[state, target_state]
+        if logger.isEnabledFor(logging.DEBUG):
+            # the state names are looked up only when they are actually logged
+            logger.debug("Going from %s to %s", state.name, target_state.name)
+            logger.debug("TMS string: %s", tms)
 
         self.driver.transmit_tms_str(tms, tdi)
-        self.state = state
+        self.state = target_state
 
     def export(self, key, value):
         print(f"EXPORT {key}={value}")
@@ -368,9 +413,9 @@ class TapController:
     def wait(self, cycles: int, usec: int=0):
         """Wait for until both (tck-)cycles and usec are satisfied"""
         if self.state in (State.RUN_TEST_IDLE, State.PAUSE_DR, State.PAUSE_IR):
-            self.driver.transmit_tms_str(bitarray("0" * cycles, 'little'))
+            self.driver.transmit_tms_str(_ZEROS[:cycles] if cycles <= len(_ZEROS) else zeros(cycles, 'little'))
         elif self.state in (State.TEST_LOGIC_RESET, ):
-            self.driver.transmit_tms_str(bitarray("1" * cycles, 'little'))
+            self.driver.transmit_tms_str(_ONES[:cycles] if cycles <= len(_ONES) else ones(cycles, 'little'))
         else:
             raise Exception(f"{self.state.name} is not a wait state")
         if usec > 500: time.sleep(usec * 1e-6)
@@ -378,25 +423,27 @@ class TapController:
     def ir_scan(self, ir: bitarray, end_state: State | None=None):
         if ir.endian != 'little': raise ValueError("ir must be little endian bitarray")
         if end_state is None:
-            logger.debug(f"IR scan {ir}")
+            logger.debug("IR scan %s", ir)
         else:
-            logger.debug(f"IR scan {ir} exit to {end_state.name}")
-        self._goto(State.SHIFT_IR)
-        ret = self.driver.transfer_tdi_tdo_str(ir, first_tms=0 if len(ir) > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_IR
-        if not end_state is None: self._goto(end_state)
+            logger.debug("IR scan %s exit to %s", ir, end_state.name)
+        with self.driver.batch():
+            self._goto(State.SHIFT_IR)
+            ret = self.driver.transfer_tdi_tdo_str(ir, first_tms=0 if len(ir) > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_IR
+            if not end_state is None: self._goto(end_state)
         self.in_extest = False
         return ret
 
     def dr_scan(self, dr: bitarray, end_state: State | None=None):
         if dr.endian != 'little': raise ValueError("dr must be little endian bitarray")
         if end_state is None:
-            logger.debug(f"DR scan {dr}")
+            logger.debug("DR scan %s", dr)
         else:
-            logger.debug(f"DR scan {dr} exit to {end_state.name}")
-        self._goto(State.SHIFT_DR)
-        ret = self.driver.transfer_tdi_tdo_str(dr, first_tms=0 if len(dr) > 1 else 1, last_tms=1)
-        self.state = State.EXIT1_DR
-        if not end_state is None: self._goto(end_state)
+            logger.debug("DR scan %s exit to %s", dr, end_state.name)
+        with self.driver.batch():
+            self._goto(State.SHIFT_DR)
+            ret = self.driver.transfer_tdi_tdo_str(dr, first_tms=0 if len(dr) > 1 else 1, last_tms=1)
+            self.state = State.EXIT1_DR
+            if not end_state is None: self._goto(end_state)
         self.in_extest = False
         return ret
@@ -241,7 +241,7 @@ async def loopback(o_pin, i_pin):
 
 async def main():
     drv = ebyst.drivers.MPSSE(ebyst.drivers.MPSSE.list_devices([(0x1514, 0x2008)])[0])
-    dev = ebyst.Device.from_bsdl("bsdl/MPF300TSFCG1152.bsdl")
+    dev = ebyst.Device.from_bsdl("bsdl/MPF300TSFCG1152.bsdl", cached=True)
     ctl = ebyst.TapController(drv)
 
     ctl.detect_chain()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import logging
+import tempfile
 
 import ebyst
 
@@ -16,10 +17,27 @@ def get_all_bsdls(root):
                 ret.append(os.path.join(root, file))
     return ret
 
+def device_state(dev):
+    return (dev.irlen, dev.max_freq, dev.idcode.pattern, dev.opcodes,
+            [(c.num, c.cell, c.port, c.function, c.safe, c.ctl_cell, c.out_dis_ctl, c.out_dis_val, c.out_value)
+             for c in dev.cells],
+            {name: (pin.input_cell and pin.input_cell.num, pin.output_cell and pin.output_cell.num,
+                    pin.control_cell and pin.control_cell.num, pin.device is dev) for name, pin in dev.pinmap.items()})
+
 if __name__ == "__main__":
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
 
+    devices = {}
     for fn in get_all_bsdls("bsdl"):
         logger.info(f"Parsing {fn}")
-        dev = ebyst.Device.from_bsdl(fn)
\ No newline at end of file
+        devices[fn] = ebyst.Device.from_bsdl(fn)
+
+    # load everything again through the cache, the first pass fills it, the second reads it
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ebyst.Device.CACHE_DIR = cache_dir
+        for fn in get_all_bsdls("bsdl"):
+            for _ in range(2):
+                logger.info(f"Loading {fn}")
+                dev = ebyst.Device.from_bsdl(fn, cached=True)
+                assert device_state(dev) == device_state(devices[fn]), fn
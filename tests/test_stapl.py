@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os, sys
 import logging
+import tempfile
 
 from ebyst.stapl import StaplFile, StaplInterpreter, StaplExitCode
 from ebyst import JtagState as State
@@ -79,7 +80,7 @@ class Checker:
         elif state == State.CAPTURE_DR:
             self.check(f"STATE DRCAPTURE")
         elif state == State.SHIFT_DR:
-            self.check(f"STATE DRSHIFt")
+            self.check(f"STATE DRSHIFT")
         elif state == State.EXIT1_DR:
             self.check(f"STATE DREXIT1")
         elif state == State.PAUSE_DR:
@@ -155,6 +156,17 @@ if __name__ == "__main__":
                 stapl = StaplFile.parse(f)
             for action in stapl.actions:
                 test_action(stapl, action)
+
+        # run everything again from the parse cache
+        with tempfile.TemporaryDirectory() as cache_dir:
+            StaplFile.CACHE_DIR = cache_dir
+            for fn in sorted(get_all_stapls("stapl/tests")):
+                for _ in range(2):
+                    logger.info(f"Loading {fn}")
+                    with open(fn, "r") as f:
+                        stapl = StaplFile.load_cached(f)
+                for action in stapl.actions:
+                    test_action(stapl, action)
     elif len(sys.argv) == 2:
         fn = sys.argv[1]
         logger.info(f"Parsing {fn}")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import glob
+import io
+import tempfile
+import unittest
+import unittest.mock
+from ebyst.stapl.stapl import Crc, StaplFile
+
+def reference_crc(s):
+    crc_register = 0xFFFF
+    for in_byte in s:
+        in_byte = ord(in_byte)
+        if in_byte != 13:
+            for _ in range(8):
+                feedback = (in_byte ^ crc_register) & 0x01
+                crc_register >>= 1
+                if feedback: crc_register ^= 0x8408
+                in_byte >>= 1
+    return (~crc_register) & 0xFFFF
+
+def crc(s):
+    return Crc(s + "CRC FFFF;", len(s), ["FFFF"]).actual
+
+class TestCrc(unittest.TestCase):
+    def test_strings(self):
+        for s in ("", "a", "123456789", "NOTE \"A\" \"B\";\r\nACTION X = Y;\r\n", "\r\r\r", "".join(chr(i) for i in range(128)),
+                  "' \u00e9 comment\nACTION A = B;\n", "".join(chr(i) for i in range(256)), "\u010d\r\u20ac\U0001f600"):
+            self.assertEqual(crc(s), reference_crc(s))
+
+    def test_files(self):
+        for fn in sorted(glob.glob("stapl/*.stp")):
+            with open(fn, "r", newline="") as f:
+                s = f.read()
+            loc = s.rindex("CRC")
+            self.assertEqual(crc(s[:loc]), reference_crc(s[:loc]), fn)
+
+    def test_expected(self):
+        with open("stapl/idcode.stp", "r", newline="") as f:
+            s = f.read()
+        loc = s.rindex("CRC")
+        self.assertTrue(Crc(s, loc, ["631B"]).is_correct())
+        self.assertFalse(Crc(s, loc, ["631C"]).is_correct())
+
+    def test_cached(self):
+        with open("stapl/idcode.stp", "r") as f:
+            s = f.read()
+        s = s[:s.rindex("CRC")] + "CRC 1234;\n"
+        with tempfile.TemporaryDirectory() as cache_dir, unittest.mock.patch.object(StaplFile, "CACHE_DIR", cache_dir):
+            # the warning must also be given when the file is loaded from the cache
+            for _ in range(2):
+                with self.assertLogs("ebyst.stapl.stapl", "WARNING"):
+                    stapl = StaplFile.load_cached(io.StringIO(s))
+                self.assertFalse(stapl.crc.is_correct())
+
+if __name__ == '__main__':
+    unittest.main()